@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import tempfile
+import subprocess
+
+import click
+
+from benchmarks.generator import SyntheticManuscript
+from benchmarks.stub import StubServer
+from path import CURRENT_PATH
+
+# Files of the builder copied in the workspace of each run
+SOURCES = ['run.py', 'path.py', 'src', 'config']
+PROJECT = 'bench'
+
+
+def make_workspace() -> str:
+    """
+    Copy of the builder in a temporary directory : data, cache and output of the run don't touch the repository.
+    :return: str, path
+    """
+    workspace = tempfile.mkdtemp(prefix='iiif_bench_')
+    for name in SOURCES:
+        source = os.path.join(CURRENT_PATH, name)
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(workspace, name), ignore=shutil.ignore_patterns('__pycache__'))
+        else:
+            shutil.copy2(source, workspace)
+    return workspace
+
+
+def output_size(path: str) -> int:
+    """
+    :param path: str, output directory
+    :return: int, bytes of the manifests (without logs)
+    """
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+               if not name.endswith('.txt'))
+
+
+def index_images(workspace: str):
+    """
+    Sidecar index of the images of the workspace, as after their upload (builds run with --NO-SSH).
+    :param workspace: str, see make_workspace
+    """
+    subprocess.run([sys.executable, '-c', 'from src.srv.sftp import Sftp; Sftp.prepare_images()'], cwd=workspace,
+                   check=True)
+
+
+def run_build(workspace: str, base: str, args: list) -> dict:
+    """
+    Run build_manifest in its own process, to measure its wall time and its peak of memory.
+    :param workspace: str, see make_workspace
+    :param base: str, URL of the stub server
+    :param args: list of str, other options of build_manifest
+    :return: dict, returncode, seconds, peak_rss (bytes)
+    """
+    command = [sys.executable, 'run.py', 'build-manifest', '--NO-SSH', '--no-cache', '-p', PROJECT,
+               '--csv', os.path.join('data', 'data_annotations', f'{PROJECT}.csv'),
+               '--source', base + '/manifest.json', '--source-scanners', base + '/manifest.json'] + args
+    with open(os.path.join(workspace, 'bench_log.txt'), 'w') as log:
+        start = time.monotonic()
+        process = subprocess.Popen(command, cwd=workspace, stdout=log, stderr=subprocess.STDOUT)
+        # resource usage of this process only
+        _, status, rusage = os.wait4(process.pid, 0)
+        seconds = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss in kilobytes on Linux, bytes on macOS
+    peak_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    return {'returncode': process.returncode, 'seconds': seconds, 'peak_rss': peak_rss}
+
+
+def scaling_exponent(results: list, key: str) -> list:
+    """
+    Exponent k of the growth between two successive scales (value ~ folios^k) : 1 is linear.
+    :param results: list of dict, results ordered by folios
+    :param key: str, measure
+    :return: list of float (None for the first scale)
+    """
+    exponents = [None]
+    for previous, result in zip(results, results[1:]):
+        if previous[key] > 0 and result[key] > 0 and result['folios'] != previous['folios']:
+            exponents.append(math.log(result[key] / previous[key]) / math.log(result['folios'] / previous['folios']))
+        else:
+            exponents.append(None)
+    return exponents
+
+
+@click.command()
+@click.option("--folios", "folios", type=str, default="10,50,200", help="Scales of the manuscript : numbers of "
+                                                                         "folios separated by commas.")
+@click.option("--annotations", "annotations", type=int, default=5, help="Annotations by folio.")
+@click.option("--layers", "layers", type=int, default=2, help="Scan images by analysis of scanner.")
+@click.option("--repeat", "repeat", type=int, default=1, help="Runs by scale (best time is kept).")
+@click.option("--max-exponent", "max_exponent", type=float, default=1.3,
+              help="Warn when time or memory grows faster than folios^max-exponent between two scales.")
+@click.option("--build-args", "build_args", type=str, default="", help="Other options of build_manifest, "
+                                                                        "e.g. '--jobs 4 --stream'.")
+@click.option("--report", "report", type=click.Path(dir_okay=False), default=None, help="JSON file of the results.")
+@click.option("--keep", "keep", type=bool, is_flag=True, help="Keep the workspaces of the runs.")
+def bench(folios, annotations, layers, repeat, max_exponent, build_args, report, keep):
+    """
+    End-to-end benchmark of build_manifest on synthetic manuscripts served by a local stub
+    (source manifest and info.json), without network nor SFTP.
+    """
+    server = StubServer().start()
+    results = []
+    try:
+        for n_folios in sorted(int(n) for n in folios.split(',')):
+            manuscript = SyntheticManuscript(server.base, n_folios, annotations=annotations, layers=layers)
+            server.manuscript = manuscript
+            runs = []
+            for _ in range(max(1, repeat)):
+                workspace = make_workspace()
+                rows = manuscript.write_csv(os.path.join(workspace, 'data', 'data_annotations', f'{PROJECT}.csv'))
+                images = manuscript.write_images(os.path.join(workspace, 'data', 'data_files', PROJECT))
+                index_images(workspace)
+                server.requests = 0
+                run = run_build(workspace, server.base, build_args.split())
+                run.update({'folios': n_folios, 'rows': rows, 'images': images, 'requests': server.requests,
+                            'output_size': output_size(os.path.join(workspace, 'output')), 'workspace': workspace})
+                if run['returncode'] != 0:
+                    print(f"Error: build of {n_folios} folios failed, see {workspace}/bench_log.txt")
+                elif not keep:
+                    shutil.rmtree(workspace, ignore_errors=True)
+                    run['workspace'] = None
+                runs.append(run)
+            results.append(min(runs, key=lambda run: run['seconds']))
+    finally:
+        server.stop()
+
+    print(f"{'folios':>8} {'rows':>8} {'images':>8} {'time (s)':>10} {'k time':>7} {'RSS (MB)':>9} {'k RSS':>6} "
+          f"{'output (MB)':>12} {'requests':>9}")
+    time_exponents = scaling_exponent(results, 'seconds')
+    rss_exponents = scaling_exponent(results, 'peak_rss')
+    for result, k_time, k_rss in zip(results, time_exponents, rss_exponents):
+        result['time_exponent'], result['rss_exponent'] = k_time, k_rss
+        print(f"{result['folios']:>8} {result['rows']:>8} {result['images']:>8} {result['seconds']:>10.2f} "
+              f"{'' if k_time is None else f'{k_time:.2f}':>7} {result['peak_rss'] / 1e6:>9.1f} "
+              f"{'' if k_rss is None else f'{k_rss:.2f}':>6} {result['output_size'] / 1e6:>12.2f} "
+              f"{result['requests']:>9}")
+    for result in results:
+        for measure, k in (('time', result['time_exponent']), ('memory', result['rss_exponent'])):
+            if k is not None and k > max_exponent:
+                print(f"Warning: {measure} grows as folios^{k:.2f} up to {result['folios']} folios.")
+
+    if report is not None:
+        with open(report, 'w') as f:
+            json.dump({'annotations': annotations, 'layers': layers, 'build_args': build_args,
+                       'results': results}, f, indent=2)
+    if any(result['returncode'] != 0 for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,129 @@
+import os
+import csv
+import random
+
+from PIL import Image
+
+from src.opt.variables import USEFULL_CSV, SCANNERS
+
+# Analyses of the main manifest (microscopy, spectrometry)
+ANALYSES = ['mVis', 'mUV', 'mIR', 'XRF', 'FORS', 'Raman']
+# Names of the scan layers by analysis (see FILENAME_RULES)
+LAYERS = {'sXRF': ['Ms59-f{folio}_deconv_{element}.png', 'Map_data-Ms59-f{folio}-deconv-{element}-lim255.png'],
+          'HS_SWIR': ['Ms59-f{folio}-obj56-frame100-dist43-SWIR_kubelkamunk-unmix_rule_{element}.png'],
+          'HS_VNIR': ['Ms59-f{folio}-obj23-frame100-1_refl_mnf{n}.png']}
+ELEMENTS = ['Fe', 'Cu', 'Pb', 'Hg', 'Ca', 'Zn', 'Mn', 'Ti']
+COLUMNS = ['Name', 'Type', 'Character', 'Tags', 'Dimensions', 'Identifier', 'X', 'Y', 'W', 'H', 'Value',
+           'Reference.1'] + USEFULL_CSV
+
+
+class SyntheticManuscript:
+    width = 4000
+    height = 6000
+
+    def __init__(self, base: str, folios: int, annotations: int = 5, layers: int = 2, seed: int = 0):
+        """
+        Synthetic manuscript to benchmark the build : source manifest, Annotate-On csv and scan images.
+        :param base: str, URL of the local server of the source manifest and its services (see benchmarks.stub)
+        :param folios: int, number of canvases
+        :param annotations: int, number of annotations by folio
+        :param layers: int, number of scan images by analysis of scanner
+        :param seed: int, same seed, same manuscript
+        """
+        self.base = base.rstrip('/')
+        self.folios = folios
+        self.annotations = annotations
+        self.layers = layers
+        self.random = random.Random(seed)
+
+    def image_id(self, folio: int) -> str:
+        return f'{self.base}/iiif/2/f{folio:04}/full/full/0/default.jpg'
+
+    def service_id(self, folio: int) -> str:
+        return f'{self.base}/iiif/2/f{folio:04}'
+
+    def canvas_id(self, folio: int) -> str:
+        return f'{self.base}/canvas/f{folio:04}'
+
+    def manifest(self, uri: str) -> dict:
+        """
+        :param uri: str, id of the manifest
+        :return: dict, source manifest (API Presentation 2.1, the level read by the builder)
+        """
+        canvases = [{'@id': self.canvas_id(n), '@type': 'sc:Canvas', 'label': f'f. {n}',
+                     'width': self.width, 'height': self.height,
+                     'images': [{'@type': 'oa:Annotation', 'motivation': 'sc:painting',
+                                 'on': self.service_id(n),
+                                 'resource': {'@id': self.image_id(n), '@type': 'dctypes:Image',
+                                              'format': 'image/jpeg', 'width': self.width,
+                                              'height': self.height,
+                                              'service': {'@context': 'http://iiif.io/api/image/2/context.json',
+                                                          '@id': self.service_id(n),
+                                                          'profile': 'http://iiif.io/api/image/2/level1.json'}}}]}
+                    for n in range(self.folios)]
+        return {'@context': 'http://iiif.io/api/presentation/2/context.json', '@id': uri, '@type': 'sc:Manifest',
+                'label': 'Synthetic manuscript', 'viewingDirection': 'left-to-right', 'metadata': [],
+                'sequences': [{'@type': 'sc:Sequence', 'canvases': canvases}]}
+
+    def info(self, uri: str) -> dict:
+        """
+        :param uri: str, id of the image service
+        :return: dict, info.json
+        """
+        return {'@context': 'http://iiif.io/api/image/2/context.json', '@id': uri, 'type': 'ImageService2',
+                'protocol': 'http://iiif.io/api/image', 'profile': 'http://iiif.io/api/image/2/level1.json',
+                'width': self.width, 'height': self.height}
+
+    def _scans(self) -> list:
+        """
+        :return: list of tuple (analysis, id of analysis, folio)
+        """
+        scanners = [analysis for analysis in SCANNERS if analysis in LAYERS]
+        return [(analysis, f'{analysis}_{n + 1}', n) for n in range(self.folios) for analysis in scanners]
+
+    def write_csv(self, filename: str) -> int:
+        """
+        Write the Annotate-On export : annotations of each folio, and scan areas of each analysis.
+        :param filename: str
+        :return: int, number of rows
+        """
+        rows = []
+        for folio in range(self.folios):
+            for n in range(self.annotations):
+                _type = self.random.choice(['rectangle', 'rectangle', 'marker'])
+                x, y = self.random.randrange(self.width - 200), self.random.randrange(self.height - 200)
+                w, h = (self.random.randrange(20, 200), self.random.randrange(20, 200)) \
+                    if _type == 'rectangle' else (0, 0)
+                rows.append({'Name': f'f{folio}_a{n}', 'Type': _type, 'Character': self.random.choice(ANALYSES),
+                             'Tags': ', '.join(self.random.sample(ELEMENTS, self.random.randint(0, 3))),
+                             'Dimensions': f'{self.width // 2} x {self.height // 2}',
+                             'Identifier': f'id{folio}-{n}', 'X': x // 2, 'Y': y // 2, 'W': w // 2, 'H': h // 2,
+                             'Value': '', 'Reference.1': self.image_id(folio)})
+        for analysis, name, folio in self._scans():
+            rows.append({'Name': name, 'Type': 'rectangle', 'Character': analysis, 'Tags': analysis,
+                         'Dimensions': f'{self.width} x {self.height}', 'Identifier': name,
+                         'X': 100, 'Y': 200, 'W': 1500, 'H': 2000, 'Value': '',
+                         'Reference.1': self.image_id(folio)})
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS, delimiter=';', restval='')
+            writer.writeheader()
+            writer.writerows(rows)
+        return len(rows)
+
+    def write_images(self, path: str) -> int:
+        """
+        Write the scan images of the project : {path}/{id of analysis}/{layer}.png
+        :param path: str, project directory (data/data_files/{project})
+        :return: int, number of images
+        """
+        n_images = 0
+        for analysis, name, folio in self._scans():
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+            for n in range(self.layers):
+                pattern = LAYERS[analysis][n % len(LAYERS[analysis])]
+                filename = pattern.format(folio=folio, element=ELEMENTS[n % len(ELEMENTS)], n=n + 1)
+                Image.new('L', (64, 96), color=n * 16 % 256).save(os.path.join(path, name, filename))
+                n_images += 1
+        return n_images
@@ -0,0 +1,54 @@
+import json
+import threading
+import http.server
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        path = self.path.split('?')[0]
+        if path == '/manifest.json':
+            document = server.manuscript.manifest(server.base + path)
+        elif path.endswith('/info.json'):
+            document = server.manuscript.info(server.base + path[:-len('/info.json')])
+        else:
+            self.send_error(404, "File not found")
+            return
+        body = json.dumps(document).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        """
+        Local stand-in of the IIIF servers : source manifest (/manifest.json) and info.json of the image services
+        of a synthetic manuscript, served in a background thread.
+        :param host: str
+        :param port: int, 0 for a free port
+        """
+        super().__init__((host, port), StubHandler)
+        self.base = f'http://{host}:{self.server_port}'
+        self.manuscript = None
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
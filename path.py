@@ -3,5 +3,7 @@ import os
 CURRENT_PATH = os.path.dirname(os.path.abspath(__file__))
 DATA_PATH = os.path.join(CURRENT_PATH, 'data')
 CONFIG_PATH = os.path.join(CURRENT_PATH, 'config')
+CACHE_PATH = os.path.join(DATA_PATH, 'cache')
+OUTPUT_PATH = os.path.join(CURRENT_PATH, 'output')
 
 INDEX_FILE = 'manuscript.json'
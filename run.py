@@ -1,20 +1,27 @@
 import os
 import sys
-import socketserver
 import logging
 from collections import namedtuple
 
 import click
-from iiif_prezi3 import Canvas, ResourceItem, AnnotationPage, Annotation
 
-from src.data import DataAnnotations
-from src.iiif import AnnotationIIIF, ManifestIIIF, ServicesIIIF, CanvasIIIF, SequenceIIIF
+from src.data import DataAnnotations, ImageIndex, ScanMetadata
+from src.writer import ManifestWriter
+from src.build import build_canvases, build_scanner_manifests
+from src.iiif import ManifestIIIF, ServicesIIIF
 from src.opt.data_variables import LANGUAGES
-from src.opt.variables import URI_CRC, ENDPOINT_MANIFEST, SCANNERS, ENDPOINT_BASE
-from src.srv.localhost import MyHttpRequestHandler
+from src.opt.variables import URI_CRC, ENDPOINT_MANIFEST, SCANNERS, FETCH_WORKERS, FETCH_PER_HOST, \
+    HTTP_CACHE_MAX_AGE, SFTP_CHANNELS, OUTPUT_PROFILES, SERVER_PORT, SOURCE_MANIFEST, \
+    SOURCE_MANIFEST_SCANNERS, MEMORY_STREAM_RATIO
+from src.srv.localhost import ManifestServer
 from src.srv.sftp import Sftp
+from src.srv.fetch import FETCHER, REGISTRY
+from src.srv.cache import HttpCache, FragmentStore
 from src.opt.tools import get_default_project
-from path import CURRENT_PATH
+from src.rules import PARSERS, load_rules
+from src.opt.profiler import PROFILER
+from src.opt.memory import MEMORY
+from path import CURRENT_PATH, CONFIG_PATH
 
 @click.group()
 def run_manifest():
@@ -23,7 +30,13 @@ def run_manifest():
 
 
 @run_manifest.command()
-@click.option("-p", "--project", "project", type=str, default=get_default_project(), help="")
+@click.option("-p", "--project", "project", type=str, default=get_default_project, help="")
+@click.option("--csv", "csv", type=click.Path(exists=True, dir_okay=False, file_okay=True),
+              default="data/data_annotations/ms59_annotation_iiif.csv", help="CSV of annotations (Annotate-On export).")
+@click.option("--source", "source", type=str, default=SOURCE_MANIFEST, help="URI of the source manifest (API "
+                                                                            "Presentation 2.0 or 2.1.1).")
+@click.option("--source-scanners", "source_scanners", type=str, default=SOURCE_MANIFEST_SCANNERS,
+              help="URI of the source manifest of the analyses manifests.")
 @click.option("--config", "config", type=click.Path(exists=True, dir_okay=False, file_okay=True),
               help="To get the YAML file configuration.")
 @click.option("-l", "--language", "language", type=click.Choice(LANGUAGES), multiple=False, default='fr',
@@ -35,8 +48,53 @@ def run_manifest():
                                                                     "/ms_59_Avranches.json you need to inquire the "
                                                                     "url : https://data.crc.fr/iiif/. The path "
                                                                     "manifests is automaticaly adding by the script.")
-@click.option("--usage-memory", "usage_memory", type=bool, default=False, is_flag=True, help="To see usage of RAM")
+@click.option("--usage-memory", "usage_memory", type=bool, default=False, is_flag=True,
+              help="To see usage of RAM : retained and peak memory by stage, deep sizes of the main structures and "
+                   "top allocation sites (tracemalloc, slower build).")
+@click.option("--memory-budget", "memory_budget", type=float, default=None,
+              help=f"Maximum resident memory in MB : output is streamed above {MEMORY_STREAM_RATIO:.0%} of the "
+                   f"budget, and the build stops above the budget.")
 @click.option("-N", "--NO-SSH", "no_ssh", type=bool, is_flag=True, help="To disable data transfer via SSH to the IIIF server. For example, if you want to run certain tests or if files have already been uploaded.")
+@click.option("--fetch-workers", "fetch_workers", type=int, default=FETCH_WORKERS,
+              help="Number of concurrent requests to get IIIF documents (info.json).")
+@click.option("--fetch-per-host", "fetch_per_host", type=int, default=FETCH_PER_HOST,
+              help="Maximum of concurrent requests by host.")
+@click.option("--no-cache", "no_cache", type=bool, is_flag=True, help="To disable the persistent cache of HTTP requests.")
+@click.option("--cache-max-age", "cache_max_age", type=int, default=HTTP_CACHE_MAX_AGE,
+              help="Seconds during which a cached document is used without revalidation with the server.")
+@click.option("--offline", "offline", type=bool, is_flag=True, help="Get IIIF documents (manifest, info.json) only from "
+                                                                    "the cache, without network.")
+@click.option("--upload-workers", "upload_workers", type=int, default=SFTP_CHANNELS,
+              help="Number of concurrent SFTP channels to upload images.")
+@click.option("--upload-transports", "upload_transports", type=int, default=1,
+              help="Number of SSH connections to spread the upload channels.")
+@click.option("--upload-rate", "upload_rate", type=float, default=None,
+              help="Bandwidth limit of uploads in MB/s (no limit by default).")
+@click.option("--sync", "sync", type=bool, is_flag=True, help="Upload only new or changed images (size, mtime) and "
+                                                              "resume interrupted uploads.")
+@click.option("--checksum", "checksum", type=bool, is_flag=True, help="With --sync, compare the checksum of images "
+                                                                      "when their modification time is different.")
+@click.option("--remote-list", "remote_list", type=bool, is_flag=True, help="To get images and their dimensions from "
+                                                                            "the server instead of the local index.")
+@click.option("--stream", "stream", type=bool, is_flag=True, help="Write each canvas on disk as soon as it is built, "
+                                                                  "to keep memory flat with big manuscripts.")
+@click.option("--output-profile", "output_profile", type=click.Choice(list(OUTPUT_PROFILES)), default='pretty',
+              help="'pretty': indented json. 'compact': minified json with precompressed .gz and .br files "
+                   "(.br needs the module brotli).")
+@click.option("-j", "--jobs", "jobs", type=int, default=1, help="Number of processes to build the manifests of the "
+                                                                 "analyses in parallel (one manifest by process).")
+@click.option("--incremental", "incremental", type=bool, is_flag=True, help="Rebuild only the canvases whose inputs "
+                                                                          "(annotations, source canvas, service, "
+                                                                          "configuration) changed since the last build.")
+@click.option("--filename-rules", "filename_rules", type=click.Path(exists=True, dir_okay=False, file_okay=True),
+              default=None, help="Yaml file of the grammar of the names of scan images (see FILENAME_RULES).")
+@click.option("--profile", "profile", type=str, default=None, help="Time the stages of the build and write "
+                                                              "{profile}.summary.json and {profile}.trace.json "
+                                                              "(chrome://tracing), e.g. output/profile.")
+@click.option("--profile-stage", "profile_stage", type=click.Choice(['fetch', 'csv', 'canvas', 'svg', 'serialize',
+                                                                     'compress', 'listing', 'scans', 'upload',
+                                                                     'scanner']),
+              default=None, help="With --profile, profile a stage with cProfile in {profile}.prof.")
 @click.option("-v", "--verbose", "verbose", type=bool, is_flag=True, help="Get more verbosity")
 def build_manifest(*args, project, **kwargs):
     """
@@ -46,321 +104,132 @@ def build_manifest(*args, project, **kwargs):
     :param kwargs:
     :return: Manifest API Presentation 3.0
     """
-    data = DataAnnotations("data/data_annotations/ms59_annotation_iiif.csv", delimiter=";")
+    if kwargs['usage_memory'] or kwargs['memory_budget'] is not None:
+        MEMORY.enable(trace=kwargs['usage_memory'],
+                      budget=int(kwargs['memory_budget'] * 1e6) if kwargs['memory_budget'] is not None else None)
+    if kwargs['profile'] is not None or kwargs['usage_memory']:
+        PROFILER.enable(cprofile_stage=kwargs['profile_stage'], memory=MEMORY if kwargs['usage_memory'] else None)
+    cache = None
+    if not kwargs['no_cache'] or kwargs['offline']:
+        cache = HttpCache(max_age=kwargs['cache_max_age'], offline=kwargs['offline'])
+    FETCHER.configure(workers=kwargs['fetch_workers'], per_host=kwargs['fetch_per_host'], cache=cache)
+    if kwargs['filename_rules'] is not None:
+        PARSERS.update(load_rules(kwargs['filename_rules']))
+    with PROFILER.stage('csv'):
+        data = DataAnnotations(kwargs['csv'], delimiter=";")
 
     ########################### Build Principal Manifest #####################################
 
-    manifest = ManifestIIIF('https://emmsm.unicaen.fr/manifests/Avranches_BM_59.json')
-    #manifest = ManifestIIIF('https://crc-centre-recherche-conservation.github.io/iiif/iiif/manifest/Avranches_BM_59.json')
-    manifest.get_preconfig('/home/maxime/Bureau/projet_crc/IIIF_builder/config/config_example.yaml')
+    with PROFILER.stage('fetch', uri=kwargs['source']):
+        manifest = ManifestIIIF(kwargs['source'])
+    manifest.get_preconfig(kwargs['config'] or os.path.join(CONFIG_PATH, 'config_example.yaml'))
     manifest.build_manifest()
+    # Configuration shared with the manifests of the analyses
+    preconfig = {key: getattr(manifest, key) for key in ('label', 'description', 'rights', 'attribution', 'metadata')}
 
     ############## Make Canvas ##############
     # Get annotation and canvas
-    for uri, values in data:
+    for uri, records in data:
         manifest.get_canvas(uri)
-        list_anno = []
-        for value in values:
-            row = data.get_row(uri, value)
-            list_anno.append(AnnotationIIIF.data_annotation(row=row))
-        manifest.annotation[uri] = list_anno
-    for n_canvas, uri_canvas in enumerate(manifest.canvases):
-        # get original data
-        canvas = manifest.canvases[uri_canvas]
-
-        # Canvas entities
-        canvas_img = Canvas(id=canvas['@id'],
-                            label=canvas['label'],
-                            width=canvas['width'],
-                            height=canvas['height'])
-
-        # Service Image
-        uri_info = canvas['images'][0]['on']
-        # get info services
-        service = ServicesIIIF(uri_info)
-        # Get canvas parameters
-        url_image = canvas['images'][0]['resource']['@id']
-        canvas_api = CanvasIIIF(url_image, verbose=kwargs['verbose'])
-        # verify api parameters and format
-        url_image = canvas_api.check_size(service.api)
-        _format = canvas_api.build_format()
-
-        # Resource image entities for canvas
-        resource_img = ResourceItem(id=url_image,
-                                    type=canvas['images'][0]['resource']['@type'],
-                                    format=_format if _format is not None else canvas['images'][0]['resource'][
-                                        'format'],  # To get correct format, but if error you got original format
-                                    height=canvas['images'][0]['resource']['height'],
-                                    width=canvas['images'][0]['resource']['width'])
-        # Add service to image
-        ## API Presentation 2.0 - 2.1
-        if manifest.api < 3.0:
-            service_info = service.get_info_image()
-            # build service
-            resource_img.make_service(id=uri_info.replace('/info.json', ''),
-                                      type=service_info.type,
-                                      profile=service_info.profile)  # maybe level1
-        ## For Presentation API 3.0
-        else:
-            resource_img.make_service(id=canvas['items'][0]['items'][0]['service'][0]['@id'],
-                                      type=canvas['items'][0]['items'][0]['service'][0]['type'],
-                                      profile=canvas['items'][0]['items'][0]['service'][0]['profile'])  # maybe level1
-
-        # Annotation for add resource image in canvas
-        anno_img = Annotation(id=kwargs['server'] + f"annotation/p{n_canvas:05}-image",
-                              motivation="painting",
-                              body=resource_img,
-                              target=canvas_img.id)
-
-        # clean variable
-        del url_image, resource_img, service, service_info, canvas_api, _format
-
-        # Page annotation for canvas
-        anno_page = AnnotationPage(
-            id=kwargs['server'] + ENDPOINT_BASE + manifest.uri_basename + '&' + f"page/p{str(n_canvas)}/1")
-        anno_page.add_item(anno_img)
-
-        ############## Write Annotations ##############
-        for n_anno, data_anno in enumerate(manifest.annotation[uri_canvas]):
-            annotation = AnnotationIIIF(canvas=canvas, data=data_anno, uri=uri_canvas, **kwargs)
-
-            forms = annotation.make_forms()
-            if n_anno > 0:
-                form_anno = Annotation(id=kwargs[
-                                              'server'] + ENDPOINT_BASE + manifest.uri_basename + '&' + f"annotation/p{n_canvas:05}-image/anno_{n_anno:01}-svg",
-                                       motivation="commenting",  # maybe other
-                                       body={"type": "TextualBody",
-                                             "language": "fr",
-                                             "format": "text/html",
-                                             "value": f"""<p><b>Type d'analyse:</b> {data_anno['Type_analysis']}</p>"""},
-                                       target={"type": "SpecificResource",
-                                               "source": canvas_img.id,
-                                               "selector": {"type": "SvgSelector", "value": forms}
-                                               })
-
-                canvas_img.add_annotation(form_anno, anno_page_id=kwargs['server'] + f"page/p{str(n_canvas)}/2")
-
-            # Add tags
-            try:
-                for n_tag, tag in enumerate(annotation.data['Tags']):
-                    anno_tag = Annotation(
-                        id=kwargs['server'] + f"annotation/p{n_canvas:05}-image/anno_{n_anno:01}/tags/{n_tag:01}",
-                        motivation="tagging",
-                        body={"type": "TextualBody",
-                              "language": "fr",
-                              "format": "text/plain",
-                              "value": f"{tag}"},
-                        target=canvas_img.id + f"#xywh={str(annotation.xywh)}")
-                    canvas_img.add_annotation(anno_tag, anno_page_id=kwargs['server'] + f"page/p{str(n_canvas)}/3")
-            # If None value for tag
-            except TypeError:
-                pass
-
-        # Add annotation by canvas
-        canvas_img.add_item(anno_page)
-        # Add canvas in manifest
-        manifest.manifest.add_item(canvas_img)
+        manifest.annotation[uri] = records
+    # Resolve concurrently all info.json of the build (main manifest, thumbnail and scanners manifests)
+    with PROFILER.stage('fetch'):
+        FETCHER.prefetch([ServicesIIIF.build_uri_info(canvas['images'][0]['on'])
+                          for canvas in manifest.canvases.values()])
 
     # build thumbnail manifest
     manifest.build_thumbnail()
+    writer = ManifestWriter(os.path.join(CURRENT_PATH, 'output', f'{manifest.uri_basename}.json'), manifest.manifest,
+                            stream=kwargs['stream'] or MEMORY.check(), profile=kwargs['output_profile']).open()
+    # Build canvases (in parallel with --jobs, only changed canvases with --incremental)
+    store = FragmentStore(manifest.uri_basename) if kwargs['incremental'] else None
+    build_canvases(writer, manifest.canvases, manifest.annotation, manifest.api, manifest.uri_basename, cache=cache,
+                   store=store, **kwargs)
+    if store is not None:
+        store.prune()
+        store.report()
+
     # print(manifest._print_json())
-    with open(os.path.join(CURRENT_PATH, 'output', f'{manifest.uri_basename}.json'), 'w') as outfile:
-        outfile.write(manifest.manifest.json(indent=2, ensure_ascii=False))
+    writer.close()
 
-    if kwargs['usage_memory']:
-        print("The size of the manifest.canvases is:", sys.getsizeof(manifest.canvases), "bytes.")
-        print("The size of the annotation is:", sys.getsizeof(manifest.annotation), "bytes.")
-        print("The size of the manifest is:", sys.getsizeof(manifest.manifest), "bytes.")
+    MEMORY.snapshot(**{'manifest.canvases': manifest.canvases, 'annotation': manifest.annotation,
+                       'manifest': manifest.manifest, 'csv': data.df})
     # Remove Manifest
     del manifest
 
     ########################### Build Collections #####################################
 
     ############## Make Scanners Manifest's ##############
+    # Local images and their sidecar index (dimensions), updated only with the upload (index of the images on the srv)
+    with PROFILER.stage('listing'):
+        list_img = Sftp.prepare_images(index=kwargs['no_ssh'] is False)
+    transfers = []
     # Upload files
     if kwargs['no_ssh'] is False:
-        list_img = Sftp.prepare_images()
         # Check if not space in filename
         if not all(' ' not in img_str for img_str in list_img):
             print('ERROR: You need to check filename of yours images. Space characters are prohibated !')
             exit()
 
-        for img in list_img:
-            try:
-                Sftp.upload_images(project=project, id_=img, imgs=list_img[img], verbose=kwargs['verbose'])
-            except Exception as e:
-                logging.error(f"Une erreur s'est produite : id: {str(img)} , {str(e)}", exc_info=True)
-
-    # Get list of resources to srv
-    list_img = Sftp.get_list_dir(project)
-
+        transfers = Sftp.upload_all(project=project, list_img=list_img, workers=kwargs['upload_workers'],
+                                    transports=kwargs['upload_transports'], rate=kwargs['upload_rate'],
+                                    sync=kwargs['sync'], checksum=kwargs['checksum'], verbose=kwargs['verbose'])
+
+    # Get list of resources with their dimensions (local index, or srv)
+    with PROFILER.stage('listing'):
+        index = ImageIndex()
+        if len(index) > 0 and not kwargs['remote_list']:
+            # images of failed transfers are not (or partially) on the server
+            failed = {transfer.remote.split('/')[-1] for transfer in transfers if transfer.error is not None}
+            list_img = {name: size for name, size in index.get_sizes().items() if name not in failed}
+        else:
+            list_img = Sftp.get_list_dir(project)
+    Sftp.close_session()
+
+    # Metadata of all scan images, and check of their names before building the manifests
+    with PROFILER.stage('scans'):
+        scans = ScanMetadata(list_img)
+    invalid = scans.validate()
+    if len(invalid) > 0:
+        print(f"Warning: {len(invalid)} scan images with an invalid name: "
+              f"{', '.join(f'{name} ({reason})' for name, reason in invalid.items())}.")
+        for name, reason in invalid.items():
+            logging.warning(f"Invalid name of scan image : {name} ({reason})")
+    # next manifests are streamed if the budget was reached
+    kwargs['stream'] = kwargs['stream'] or MEMORY.check()
+
+    # Build manifest of each analysis (in parallel with --jobs)
+    results = build_scanner_manifests(list(SCANNERS), kwargs['source_scanners'], project, data, ManifestIIIF.canvases,
+                                      list_img, preconfig, cache=cache, scans=scans, **kwargs)
+
+    stats = REGISTRY.stats()
+    if kwargs['jobs'] > 1:
+        # add documents resolved in the workers
+        stats = stats._replace(hits=stats.hits + sum(result.hits for result in results),
+                               misses=stats.misses + sum(result.misses for result in results))
+    logging.info(f"Remote documents: {stats.documents} (hits: {stats.hits}, misses: {stats.misses})")
+    if kwargs['verbose']:
+        print(f"Remote documents: {stats.documents} (hits: {stats.hits}, misses: {stats.misses})")
+    if kwargs['profile'] is not None:
+        PROFILER.save(kwargs['profile'])
+    MEMORY.report()
+
+    # Report of all analyses
     Error = namedtuple('Error', ['n', 'list_id'])
-    error = Error(n=0, list_id=[])
-
-    # Iter on analysis
-    for n, analysis in enumerate(SCANNERS):
-        manifest_scan = ManifestIIIF(
-            'https://crc-centre-recherche-conservation.github.io/iiif/iiif/manifest/Avranches_BM_59.json', **kwargs)
-        manifest_scan.uri_basename = manifest_scan.uri_manifest.split('/')[-1].replace('.json', f'_{analysis}')
-        manifest_scan.build_manifest(url=manifest_scan.uri_manifest.replace('.json', f'_{analysis}.json'))
-
-        # Hyperspectral and XRF
-        if analysis != 'MSP':
-            # Get and iter on rows by analysis type
-            list_analysis = data.get_type_analysis(_type=analysis)
-
-            canvas_images = {}
-
-            # iterating
-            for index, row in list_analysis.sort_values(by='Reference.1').iterrows():
-
-                # Page annotation for canvas
-                anno_page_scan = AnnotationPage(
-                    id=kwargs['server'] + ENDPOINT_BASE + manifest_scan.uri_basename + '&' + f"page/p{str(index)}/1")
-
-                #get variable
-                label_id = row['Name']
-                img_url_1 = row['Reference.1']
-
-                ##### Build 1st Canvas and Image #####
-                canvas = manifest_scan.canvases[img_url_1]
-                # Canvas entities
-
-                if img_url_1 not in canvas_images:
-                    # New canvas
-                    canvas_img = Canvas(id=canvas['@id'],
-                                        label=canvas['label'],
-                                        width=canvas['width'],
-                                        height=canvas['height'])
-
-                    # Service Image
-                    uri_info = canvas['images'][0]['on']
-                    # get info services
-                    service = ServicesIIIF(uri_info, **kwargs)
-                    # Get canvas parameters
-                    url_image = canvas['images'][0]['resource']['@id']
-                    canvas_api = CanvasIIIF(url_image, verbose=kwargs['verbose'])
-                    # verify api parameters and format
-                    url_image = canvas_api.check_size(service.api)
-                    _format = canvas_api.build_format()
-                    try:
-                        resource_principal_img = ResourceItem(id=url_image,
-                                                          type=canvas['images'][0]['resource']['@type'],
-                                                          format=_format if _format is not None else
-                                                          canvas['images'][0]['resource']['format'],
-                                                          # To get correct format, but if error you got original format
-                                                          height=canvas['images'][0]['resource']['height'],
-                                                          width=canvas['images'][0]['resource']['width'])
-                    except Exception as e:
-                        logging.error(f"Une erreur s'est produite : id: {str(url_image)} , {str(e)}", exc_info=True)
-
-                    # Add service to image
-                    ## API Presentation 2.0 - 2.1 (related to original manifest)
-                    if manifest_scan.api < 3.0:
-                        service_info = service.get_info_image()
-                        # build service
-                        resource_principal_img.make_service(id=uri_info.replace('/info.json', ''),
-                                                            type=service_info.type,
-                                                            profile='level1')  # maybe level1
-                    ## For Presentation API 3.0
-                    else:
-                        resource_principal_img.make_service(id=canvas['items'][0]['items'][0]['service'][0]['@id'],
-                                                            type=canvas['items'][0]['items'][0]['service'][0]['type'],
-                                                            profile='level1')
-
-                    # Annotation for add resource image in canvas
-                    anno_principal_img = Annotation(id=kwargs['server'] + f"annotation/{label_id}-main-images",
-                                                    motivation="painting",
-                                                    body=resource_principal_img,
-                                                    target=canvas_img.id)
-
-                    # Add annotation to anno page
-                    anno_page_scan.add_item(anno_principal_img)
-
-                    # Add new canvas to dict
-                    canvas_images[img_url_1] = canvas_img
-
-                # To future layers
-                else:
-                    canvas_img = canvas_images[img_url_1]
-
-
-                ##### Build others Images (Scans) #####
-                idx_img = list(filter(lambda x: x.startswith(row['Name']), list(list_img.keys())))
-                # Check if id is empty
-                if len(idx_img) == 0:
-                    error.n += 1
-                    error.list_id.append(row['Name'])
-
-                #list_img[name_img_layer] = (w, h)
-                for img in idx_img:
-                    sequence_img = SequenceIIIF(project=project, filename=img, **kwargs)
-
-                    url_image_scan = sequence_img.build_url_V3()
-
-                    try:
-                        resource_scan = ResourceItem(id=url_image_scan,
-                                                 type='Image',
-                                                 format=sequence_img.format if sequence_img.format is not None else 'image/jpeg',
-                                                 height=list_img[img][1],
-                                                 width=list_img[img][0])
-                    except Exception:
-                        print('ERROR')
-                        print(url_image_scan)
-
-
-                    if analysis == 'sXRF':
-                        try:
-                            labels, element = sequence_img.get_mtda_xrf(url_image_scan)
-                        except KeyError:
-                            print(url_image_scan)
-                    elif analysis == 'HS_SWIR' or analysis == 'HS_VNIR':
-                        labels, element = sequence_img.get_mtda_hs(url_image_scan)
-                    resource_scan.add_label(' | '.join(labels), language='fr')
-
-                    # Services
-                    resource_scan.make_service(id=sequence_img.build_uri(),
-                                               type='ImageService3',
-                                               profile='level2')
-
-                    # Add to annotation
-
-                    ## tuple origin size
-                    t_dim = (int(row['Dimensions'].split('x')[0].strip()),int(row['Dimensions'].split('x')[1].strip()))
-
-                    anno_img_scan = Annotation(id=kwargs['server'] + f"annotation/{label_id}-alt-images-{element}",
-                                               motivation="painting",
-                                               body=resource_scan,
-                                               # list_img -> correspond to dict parsing files sftp
-                                               target=canvas_img.id + '#xywh=' + sequence_img.get_xywh(canvas=canvas_img,
-                                                                                                  row=row,
-                                                                                                  image_size=t_dim))
-                    if kwargs['verbose']:
-                        print("tags urls :" + anno_img_scan.target)
-                    # Add annotation to anno page
-                    anno_page_scan.add_item(anno_img_scan)
-
-                # Add annotation by canvas
-                canvas_img.add_item(anno_page_scan)
-                # Add update canvas
-                canvas_images[img_url_1] = canvas_img
-
-            # Add canvas in manifest
-            for url_base in canvas_images:
-                manifest_scan.manifest.add_item(canvas_images[url_base])
-
-        # Multispectral
-        elif analysis == 'MSP':
-            pass
-
-
-        with open(os.path.join(CURRENT_PATH, 'output', f'{manifest_scan.uri_basename}.json'), 'w') as outfile:
-            outfile.write(manifest_scan.manifest.json(indent=2, ensure_ascii=False))
-
+    unmatched = list(dict.fromkeys(_id for result in results for _id in result.unmatched))
+    ambiguous = list(dict.fromkeys(_id for result in results for _id in result.ambiguous))
+    error = Error(n=len(unmatched), list_id=unmatched)
+    failed = [result for result in results if result.error is not None]
+    if len(ambiguous) > 0:
+        print(f"Warning: identifiers sharing a prefix with other identifiers: {', '.join(ambiguous)}.")
+    for result in failed:
+        print(f"Error building the manifest {result.analysis}: {str(result.error)}")
     if error.n > 0:
         print(f"Error identifying images from the following identifiers: {', '.join(error.list_id)}.")
         print(f"Please check the integrity of the 'data_files' folder.")
         exit(0)
+    if len(failed) > 0:
+        exit(1)
 
     # https://iiif-prezi.github.io/iiif-prezi3/recipes/0230-navdate/#example-3-collection_1
 
@@ -368,17 +237,16 @@ def build_manifest(*args, project, **kwargs):
 
 
 @run_manifest.command()
-def server_manifest():
-    # Create an object of the above class
-    handler_object = MyHttpRequestHandler
-
-    PORT = 8000
+@click.option("--host", "host", type=str, default="", help="Address to listen (all interfaces by default).")
+@click.option("--port", "port", type=int, default=SERVER_PORT, help="Port to listen (0 for a free port).")
+def server_manifest(host, port):
     try:
-        my_server = socketserver.TCPServer(("", PORT), handler_object)
-    except OSError:
-        PORT += 1
-        my_server = socketserver.TCPServer(("", PORT), handler_object)
-    print("Listening on http://localhost:%s" % PORT)
+        my_server = ManifestServer((host, port))
+    except OSError as err:
+        print(f"Unable to listen on {host or '0.0.0.0'}:{port} ({str(err)}). Choose another port with --port.")
+        logging.error(f"Une erreur s'est produite : serveur : {str(err)}")
+        sys.exit(1)
+    print("Listening on http://%s:%s" % (host or 'localhost', my_server.server_port))
     # Star the server
     try:
         my_server.serve_forever()
@@ -389,6 +257,7 @@ def server_manifest():
 
 if __name__ == "__main__":
     # Configuration du système de logs
+    os.makedirs('output', exist_ok=True)
     logging.basicConfig(filename='output/logfile.txt', level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s')
     run_manifest()
@@ -0,0 +1,506 @@
+import os
+import logging
+import tracemalloc
+from collections import namedtuple
+from functools import partial
+from contextlib import ExitStack
+from multiprocessing.util import Finalize
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from iiif_prezi3 import Canvas, ResourceItem, AnnotationPage, Annotation, config
+
+from src.forms import AnnotationTable
+from src.writer import ManifestWriter
+from src.iiif import AnnotationIIIF, ManifestIIIF, ServicesIIIF, CanvasIIIF, SequenceIIIF
+from src.data import ScanMetadata, report_errors
+from src.opt.variables import ENDPOINT_BASE
+from src.opt.tools import PrefixIndex
+from src.opt.profiler import PROFILER
+from src.opt.memory import MEMORY
+from src.srv.fetch import FETCHER, REGISTRY
+from src.srv.cache import HttpCache, FragmentStore
+from path import CURRENT_PATH
+
+# Result of the build of a scanner manifest (error is None if succeed)
+ScanResult = namedtuple('ScanResult', ['analysis', 'unmatched', 'ambiguous', 'hits', 'misses', 'error'])
+
+
+def init_worker(fetch: dict, cache: dict or None, documents: dict, language: str, profile: str = None):
+    """
+    Initialize a worker process : its own HTTP pool, and the documents already resolved by the parent
+    (source manifest, info.json) so that they are not requested again.
+    :param fetch: dict, arguments of Fetcher.configure (workers, per_host)
+    :param cache: dict, arguments of HttpCache (None without cache)
+    :param documents: dict, {uri: json}
+    :param language: str, language of the labels of the parent
+    :param profile: str, prefix of the profile of the parent (None if disabled)
+    """
+    FETCHER.configure(cache=HttpCache(**cache) if cache is not None else None, **fetch)
+    REGISTRY.documents.update(documents)
+    config.configs['helpers.auto_fields.AutoLang'].auto_lang = language
+    # memory is accounted in the main process only
+    tracemalloc.stop()
+    if profile is not None:
+        # spans of the worker are written when it stops, and merged by the parent
+        PROFILER.enable()
+        Finalize(PROFILER, PROFILER.dump, args=(f'{profile}.worker-{os.getpid()}.json',), exitpriority=10)
+    else:
+        PROFILER.enabled = False
+        PROFILER.memory = None
+
+
+def worker_pool(workers: int, cache: HttpCache = None, **kwargs) -> ProcessPoolExecutor:
+    """
+    Pool of processes which start with the state of the parent needed to build manifests.
+    :param workers: int, number of processes
+    :param cache: HttpCache, persistent cache of the parent (None without cache)
+    :param kwargs: options of build_manifest
+    :return: ProcessPoolExecutor
+    """
+    # Workers start with the documents already resolved (source manifest, info.json)
+    documents = {key: document for key, document in REGISTRY.documents.items() if isinstance(key, str)}
+    cache_args = None
+    if cache is not None:
+        cache.save()
+        cache_args = {'path': cache.path, 'max_age': cache.max_age, 'max_size': cache.max_size,
+                      'offline': cache.offline}
+    fetch_args = {'workers': kwargs['fetch_workers'], 'per_host': kwargs['fetch_per_host']}
+    language = config.configs['helpers.auto_fields.AutoLang'].auto_lang
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                               initargs=(fetch_args, cache_args, documents, language, kwargs.get('profile')))
+
+
+def build_canvas(n_canvas: int, uri_canvas: str, canvas: dict, records: list, api: float, uri_basename: str,
+                 **kwargs) -> Canvas:
+    """
+    Build canvas of the main manifest : image of the source canvas with its service, and the annotations
+    (svg forms and tags) of the csv.
+    :param n_canvas: int, position of the canvas in the manifest
+    :param uri_canvas: str, uri of the image in the csv
+    :param canvas: dict, canvas of the source manifest
+    :param records: list of dict, annotations of the canvas (see AnnotationIIIF.data_annotations)
+    :param api: float, level API Presentation of the source manifest
+    :param uri_basename: str, name of the manifest
+    :param kwargs: options of build_manifest
+    :return: Canvas
+    """
+    # Canvas entities
+    canvas_img = Canvas(id=canvas['@id'],
+                        label=canvas['label'],
+                        width=canvas['width'],
+                        height=canvas['height'])
+
+    # Service Image
+    uri_info = canvas['images'][0]['on']
+    # get info services
+    service = ServicesIIIF(uri_info)
+    # Get canvas parameters
+    url_image = canvas['images'][0]['resource']['@id']
+    canvas_api = CanvasIIIF(url_image, verbose=kwargs['verbose'])
+    # verify api parameters and format
+    url_image = canvas_api.check_size(service.api)
+    _format = canvas_api.build_format()
+
+    # Resource image entities for canvas
+    resource_img = ResourceItem(id=url_image,
+                                type=canvas['images'][0]['resource']['@type'],
+                                format=_format if _format is not None else canvas['images'][0]['resource'][
+                                    'format'],  # To get correct format, but if error you got original format
+                                height=canvas['images'][0]['resource']['height'],
+                                width=canvas['images'][0]['resource']['width'])
+    # Add service to image
+    ## API Presentation 2.0 - 2.1
+    if api < 3.0:
+        service_info = service.get_info_image()
+        # build service
+        resource_img.make_service(id=uri_info.replace('/info.json', ''),
+                                  type=service_info.type,
+                                  profile=service_info.profile)  # maybe level1
+    ## For Presentation API 3.0
+    else:
+        resource_img.make_service(id=canvas['items'][0]['items'][0]['service'][0]['@id'],
+                                  type=canvas['items'][0]['items'][0]['service'][0]['type'],
+                                  profile=canvas['items'][0]['items'][0]['service'][0]['profile'])  # maybe level1
+
+    # Annotation for add resource image in canvas
+    anno_img = Annotation(id=kwargs['server'] + f"annotation/p{n_canvas:05}-image",
+                          motivation="painting",
+                          body=resource_img,
+                          target=canvas_img.id)
+
+    # Page annotation for canvas
+    anno_page = AnnotationPage(
+        id=kwargs['server'] + ENDPOINT_BASE + uri_basename + '&' + f"page/p{str(n_canvas)}/1")
+    anno_page.add_item(anno_img)
+
+    ############## Write Annotations ##############
+    # fit all forms of the canvas in one step
+    table = AnnotationTable.from_records(records).fit(
+        canvas_w=canvas['images'][0]['resource']['width'],
+        canvas_h=canvas['images'][0]['resource']['height'])
+    for n_anno, data_anno in enumerate(records):
+        annotation = AnnotationIIIF(canvas=canvas, data=data_anno, uri=uri_canvas, table=table, n=n_anno,
+                                    **kwargs)
+
+        with PROFILER.stage('svg'):
+            forms = annotation.make_forms()
+        if n_anno > 0:
+            form_anno = Annotation(id=kwargs[
+                                          'server'] + ENDPOINT_BASE + uri_basename + '&' + f"annotation/p{n_canvas:05}-image/anno_{n_anno:01}-svg",
+                                   motivation="commenting",  # maybe other
+                                   body={"type": "TextualBody",
+                                         "language": "fr",
+                                         "format": "text/html",
+                                         "value": f"""<p><b>Type d'analyse:</b> {data_anno['Type_analysis']}</p>"""},
+                                   target={"type": "SpecificResource",
+                                           "source": canvas_img.id,
+                                           "selector": {"type": "SvgSelector", "value": forms}
+                                           })
+
+            canvas_img.add_annotation(form_anno, anno_page_id=kwargs['server'] + f"page/p{str(n_canvas)}/2")
+
+        # Add tags
+        try:
+            for n_tag, tag in enumerate(annotation.data['Tags']):
+                anno_tag = Annotation(
+                    id=kwargs['server'] + f"annotation/p{n_canvas:05}-image/anno_{n_anno:01}/tags/{n_tag:01}",
+                    motivation="tagging",
+                    body={"type": "TextualBody",
+                          "language": "fr",
+                          "format": "text/plain",
+                          "value": f"{tag}"},
+                    target=canvas_img.id + f"#xywh={str(annotation.xywh)}")
+                canvas_img.add_annotation(anno_tag, anno_page_id=kwargs['server'] + f"page/p{str(n_canvas)}/3")
+        # If None value for tag
+        except TypeError:
+            pass
+
+    # Add annotation by canvas
+    canvas_img.add_item(anno_page)
+    return canvas_img
+
+
+def build_fragment(job: tuple, **kwargs) -> str:
+    """
+    Build canvas of the main manifest and serialize it (run in a worker process).
+    :param job: tuple, arguments of build_canvas
+    :param kwargs: options of build_manifest
+    :return: str, fragment of manifest (see ManifestWriter.serialize)
+    """
+    with PROFILER.stage('canvas'):
+        canvas = build_canvas(*job, **kwargs)
+    return ManifestWriter(None, None, profile=kwargs['output_profile']).serialize(canvas)
+
+
+def build_canvases(writer: ManifestWriter, canvases: dict, annotations: dict, api: float, uri_basename: str,
+                   cache: HttpCache = None, store: FragmentStore = None, **kwargs) -> int:
+    """
+    Build and write all canvases of the main manifest in the order of canvases, one after the other or in a pool
+    of processes. Canvases are reassembled in order : output is the same as one after the other.
+    With a store (incremental build), canvases whose inputs didn't change since the last build are taken from the
+    store instead of being rebuilt.
+    :param writer: ManifestWriter, opened
+    :param canvases: dict, {uri: canvas of the source manifest}
+    :param annotations: dict, {uri: annotations of the canvas}
+    :param api: float, level API Presentation of the source manifest
+    :param uri_basename: str, name of the manifest
+    :param cache: HttpCache, persistent cache of the parent (None without cache)
+    :param store: FragmentStore, serialized canvases of the previous builds (None to build all canvases)
+    :param kwargs: options of build_manifest, jobs : number of processes (1 to build in the main process)
+    :return: int, number of canvases
+    """
+    jobs = [(n_canvas, uri_canvas, canvases[uri_canvas], annotations[uri_canvas], api, uri_basename)
+            for n_canvas, uri_canvas in enumerate(canvases)]
+    parallel = kwargs.get('jobs', 1) > 1 and len(jobs) > 1
+    if store is None and not parallel:
+        for job in jobs:
+            with PROFILER.stage('canvas'):
+                canvas = build_canvas(*job, **kwargs)
+            writer.write(canvas)
+            MEMORY.check(writer)
+        return len(jobs)
+
+    # info.json are resolved once in the parent and given to the workers
+    services = {job[1]: ServicesIIIF(job[2]['images'][0]['on']).json for job in jobs}
+
+    fingerprints = [None] * len(jobs)
+    todo = list(range(len(jobs)))
+    if store is not None:
+        for n, job in enumerate(jobs):
+            n_canvas, uri_canvas, canvas, records, api, uri_basename = job
+            fingerprints[n] = store.fingerprint(n_canvas=n_canvas, uri=uri_canvas, canvas=canvas, records=records,
+                                                service=services[uri_canvas], api=api, manifest=uri_basename,
+                                                server=kwargs['server'], profile=kwargs['output_profile'],
+                                                language=config.configs['helpers.auto_fields.AutoLang'].auto_lang)
+        todo = [n for n in todo if not store.has(fingerprints[n])]
+
+    with ExitStack() as stack:
+        if parallel and len(todo) > 1:
+            executor = stack.enter_context(worker_pool(kwargs['jobs'], cache=cache, **kwargs))
+            # chunks of canvases to limit the exchanges between processes
+            chunksize = max(1, len(todo) // (kwargs['jobs'] * 4))
+            built = executor.map(partial(build_fragment, **kwargs), [jobs[n] for n in todo], chunksize=chunksize)
+        else:
+            built = (build_fragment(jobs[n], **kwargs) for n in todo)
+
+        # canvases rebuilt are returned in order : merge them with the stored ones
+        rebuilt = set(todo)
+        for n in range(len(jobs)):
+            if n in rebuilt:
+                fragment = next(built)
+                if store is not None:
+                    store.put(fingerprints[n], fragment)
+            else:
+                fragment = store.get(fingerprints[n])
+            writer.write_fragment(fragment)
+            MEMORY.check(writer)
+    return len(jobs)
+
+
+def build_scanner_manifest(analysis: str, uri_source: str, project: str, list_analysis: pd.DataFrame, canvases: dict,
+                           list_img: dict, preconfig: dict, scans: dict, index: PrefixIndex, **kwargs) -> ScanResult:
+    """
+    Build and write the manifest of one analysis (sXRF, HS_SWIR, HS_VNIR, MSP). Runs in the main process or in
+    a worker process : all the inputs are given in arguments.
+    :param analysis: str, type of analysis (see SCANNERS)
+    :param uri_source: str, URI of the source manifest
+    :param project: str, project name
+    :param list_analysis: pd.DataFrame, rows of the analysis
+    :param canvases: dict, {uri: canvas of the source manifest}
+    :param list_img: dict, {remote name: (width, height)}
+    :param preconfig: dict, attributes of the main manifest set by its configuration (label, metadata, etc.)
+    :param scans: dict, {remote name: (label, element)} of the images of the analysis (see ScanMetadata.get)
+    :param index: PrefixIndex, sorted names of list_img
+    :param kwargs: options of build_manifest
+    :return: ScanResult
+    """
+    hits, misses = REGISTRY.hits, REGISTRY.misses
+    # Index of remote names to find the images of the analysis
+    index_img = index.view()
+
+    manifest_scan = ManifestIIIF(uri_source, **kwargs)
+    for key, value in preconfig.items():
+        setattr(manifest_scan, key, value)
+    manifest_scan.uri_basename = manifest_scan.uri_manifest.split('/')[-1].replace('.json', f'_{analysis}')
+    manifest_scan.build_manifest(url=manifest_scan.uri_manifest.replace('.json', f'_{analysis}.json'))
+    writer = ManifestWriter(os.path.join(CURRENT_PATH, 'output', f'{manifest_scan.uri_basename}.json'),
+                            manifest_scan.manifest, stream=kwargs['stream'] or MEMORY.check(),
+                            profile=kwargs['output_profile']).open()
+
+    # Hyperspectral and XRF
+    if analysis != 'MSP':
+        canvas_images = {}
+
+        # fit scan areas of all rows on their canvas in one step
+        list_analysis = list_analysis.sort_values(by='Reference.1')
+        table, errors = AnnotationTable.from_frame(list_analysis)
+        report_errors(errors)
+        # malformed rows are skipped
+        list_analysis = list_analysis.drop(index=sorted({error.row for error in errors}))
+        table.fit(
+            canvas_w=list_analysis['Reference.1'].map(lambda uri: canvases[uri]['width']),
+            canvas_h=list_analysis['Reference.1'].map(lambda uri: canvases[uri]['height']))
+
+        # iterating
+        for n_row, (index, row) in enumerate(list_analysis.iterrows()):
+
+            # Page annotation for canvas
+            anno_page_scan = AnnotationPage(
+                id=kwargs['server'] + ENDPOINT_BASE + manifest_scan.uri_basename + '&' + f"page/p{str(index)}/1")
+
+            #get variable
+            label_id = row['Name']
+            img_url_1 = row['Reference.1']
+
+            ##### Build 1st Canvas and Image #####
+            canvas = canvases[img_url_1]
+            # Canvas entities
+
+            if img_url_1 not in canvas_images:
+                # Previous canvases are finished (rows sorted by canvas) : write and release them
+                if MEMORY.check(writer) or writer.stream:
+                    for url_base in list(canvas_images):
+                        writer.write(canvas_images.pop(url_base))
+
+                # New canvas
+                canvas_img = Canvas(id=canvas['@id'],
+                                    label=canvas['label'],
+                                    width=canvas['width'],
+                                    height=canvas['height'])
+
+                # Service Image
+                uri_info = canvas['images'][0]['on']
+                # get info services
+                service = ServicesIIIF(uri_info, **kwargs)
+                # Get canvas parameters
+                url_image = canvas['images'][0]['resource']['@id']
+                canvas_api = CanvasIIIF(url_image, verbose=kwargs['verbose'])
+                # verify api parameters and format
+                url_image = canvas_api.check_size(service.api)
+                _format = canvas_api.build_format()
+                try:
+                    resource_principal_img = ResourceItem(id=url_image,
+                                                          type=canvas['images'][0]['resource']['@type'],
+                                                          format=_format if _format is not None else
+                                                          canvas['images'][0]['resource']['format'],
+                                                          # To get correct format, but if error you got original format
+                                                          height=canvas['images'][0]['resource']['height'],
+                                                          width=canvas['images'][0]['resource']['width'])
+                except Exception as e:
+                    logging.error(f"Une erreur s'est produite : id: {str(url_image)} , {str(e)}", exc_info=True)
+
+                # Add service to image
+                ## API Presentation 2.0 - 2.1 (related to original manifest)
+                if manifest_scan.api < 3.0:
+                    service_info = service.get_info_image()
+                    # build service
+                    resource_principal_img.make_service(id=uri_info.replace('/info.json', ''),
+                                                        type=service_info.type,
+                                                        profile='level1')  # maybe level1
+                ## For Presentation API 3.0
+                else:
+                    resource_principal_img.make_service(id=canvas['items'][0]['items'][0]['service'][0]['@id'],
+                                                        type=canvas['items'][0]['items'][0]['service'][0]['type'],
+                                                        profile='level1')
+
+                # Annotation for add resource image in canvas
+                anno_principal_img = Annotation(id=kwargs['server'] + f"annotation/{label_id}-main-images",
+                                                motivation="painting",
+                                                body=resource_principal_img,
+                                                target=canvas_img.id)
+
+                # Add annotation to anno page
+                anno_page_scan.add_item(anno_principal_img)
+
+                # Add new canvas to dict
+                canvas_images[img_url_1] = canvas_img
+
+            # To future layers
+            else:
+                canvas_img = canvas_images[img_url_1]
+
+            ##### Build others Images (Scans) #####
+            idx_img = index_img.lookup(row['Name'])
+
+            #list_img[name_img_layer] = (w, h)
+            for img in idx_img:
+                sequence_img = SequenceIIIF(project=project, filename=img, **kwargs)
+
+                url_image_scan = sequence_img.build_url_V3()
+
+                try:
+                    resource_scan = ResourceItem(id=url_image_scan,
+                                                 type='Image',
+                                                 format=sequence_img.format if sequence_img.format is not None else 'image/jpeg',
+                                                 height=list_img[img][1],
+                                                 width=list_img[img][0])
+                except Exception:
+                    print('ERROR')
+                    print(url_image_scan)
+
+                # metadata of the layer extracted before the build (invalid names are reported by validate)
+                label, element = scans.get(img, ('', 'unknow'))
+                resource_scan.add_label(label, language='fr')
+
+                # Services
+                resource_scan.make_service(id=sequence_img.build_uri(),
+                                           type='ImageService3',
+                                           profile='level2')
+
+                # Add to annotation
+                anno_img_scan = Annotation(id=kwargs['server'] + f"annotation/{label_id}-alt-images-{element}",
+                                           motivation="painting",
+                                           body=resource_scan,
+                                           # list_img -> correspond to dict parsing files sftp
+                                           target=canvas_img.id + '#xywh=' + sequence_img.get_xywh(table=table,
+                                                                                                   n=n_row))
+                if kwargs['verbose']:
+                    print("tags urls :" + anno_img_scan.target)
+                # Add annotation to anno page
+                anno_page_scan.add_item(anno_img_scan)
+
+            # Add annotation by canvas
+            canvas_img.add_item(anno_page_scan)
+            # Add update canvas
+            canvas_images[img_url_1] = canvas_img
+
+        # Add canvas in manifest
+        for url_base in canvas_images:
+            writer.write(canvas_images[url_base])
+
+    # Multispectral
+    elif analysis == 'MSP':
+        pass
+
+    writer.close()
+    return ScanResult(analysis=analysis, unmatched=index_img.unmatched, ambiguous=index_img.ambiguous,
+                      hits=REGISTRY.hits - hits, misses=REGISTRY.misses - misses, error=None)
+
+
+def run_scanner_manifest(analysis: str, *args, **kwargs) -> ScanResult:
+    """
+    build_scanner_manifest timed as the stage 'scanner' (in the main process or in a worker)
+    :param analysis: str, type of analysis
+    :return: ScanResult
+    """
+    with PROFILER.stage('scanner', analysis=analysis):
+        return build_scanner_manifest(analysis, *args, **kwargs)
+
+
+def build_scanner_manifests(analyses: list, uri_source: str, project: str, data, canvases: dict, list_img: dict,
+                            preconfig: dict, cache: HttpCache = None, scans: ScanMetadata = None, **kwargs) -> list:
+    """
+    Build the manifests of the analyses, one after the other or in parallel in a pool of processes (one manifest
+    by worker). An analysis which fails doesn't stop the others : its error is in its result.
+    :param analyses: list of str, analyses (see SCANNERS)
+    :param uri_source: str, URI of the source manifest
+    :param project: str, project name
+    :param data: DataAnnotations
+    :param canvases: dict, {uri: canvas of the source manifest}
+    :param list_img: dict, {remote name: (width, height)}
+    :param preconfig: dict, attributes of the main manifest set by its configuration (label, metadata, etc.)
+    :param cache: HttpCache, persistent cache of the parent (None without cache)
+    :param scans: ScanMetadata, metadata of the images of list_img (extracted here if None)
+    :param kwargs: options of build_manifest, jobs : number of processes (1 to build in the main process)
+    :return: list of ScanResult, in the order of analyses
+    """
+    # Source manifest and info.json of the canvases are requested once for all the analyses
+    ManifestIIIF(uri_source, **kwargs)
+    inputs = {analysis: data.get_type_analysis(_type=analysis) for analysis in analyses}
+    uris_info = {ServicesIIIF.build_uri_info(canvases[uri]['images'][0]['on'])
+                 for list_analysis in inputs.values() for uri in list_analysis['Reference.1'].unique()}
+    FETCHER.prefetch(uris_info)
+    for uri_info in uris_info:
+        ServicesIIIF(uri_info, **kwargs)
+    # names of the scan images are parsed once for all the analyses : the manifests only look up their metadata
+    if scans is None:
+        scans = ScanMetadata(list_img)
+    scans = {analysis: scans.get(analysis) for analysis in analyses}
+    # Index of remote names shared by the analyses
+    index = PrefixIndex(list_img)
+
+    jobs = kwargs.get('jobs', 1)
+    if jobs <= 1:
+        results = []
+        for analysis in analyses:
+            try:
+                results.append(run_scanner_manifest(analysis, uri_source, project, inputs[analysis], canvases,
+                                                    list_img, preconfig, scans[analysis], index, **kwargs))
+            except Exception as err:
+                logging.error(f"Une erreur s'est produite : {analysis} , {str(err)}", exc_info=True)
+                results.append(ScanResult(analysis, [], [], 0, 0, err))
+        return results
+
+    with worker_pool(min(jobs, len(analyses)), cache=cache, **kwargs) as executor:
+        futures = [executor.submit(run_scanner_manifest, analysis, uri_source, project, inputs[analysis], canvases,
+                                   list_img, preconfig, scans[analysis], index, **kwargs)
+                   for analysis in analyses]
+        results = []
+        for analysis, future in zip(analyses, futures):
+            try:
+                results.append(future.result())
+            except Exception as err:
+                logging.error(f"Une erreur s'est produite : {analysis} , {str(err)}")
+                results.append(ScanResult(analysis, [], [], 0, 0, err))
+    return results
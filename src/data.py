@@ -1,13 +1,39 @@
+import os
+import json
+import hashlib
+import logging
 import pandas as pd
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
 
-from src.opt.variables import USEFULL_CSV, IMPORTANT_COLUMNS
+from path import DATA_PATH
+from src.iiif import AnnotationIIIF, SequenceIIIF
+from src.rules import PARSERS
+from src.opt.probe import get_image_size
+from src.opt.variables import USEFULL_CSV, IMPORTANT_COLUMNS, SCANNERS, SCANNER_RULES, SCAN_ID, SCAN_FOLIO
+
+
+def report_errors(errors: list):
+    """
+    Print one report of the malformed rows of the csv, not kept (details in logs)
+    :param errors: list of ParseError(row, name, field, message)
+    """
+    if len(errors) > 0:
+        for error in errors:
+            logging.warning(f"Annotation '{error.name}' (row {error.row}), column {error.field}: {error.message}")
+        fields = sorted(set(error.field for error in errors))
+        print(f"!Error : {len(errors)} malformed values in the csv (columns: {', '.join(fields)}). "
+              f"Check the logfile to get details.")
 
 
 class DataAnnotations:
-    annotations = {}
 
     def __init__(self, filename, **kwargs):
         self.file = filename
+        # {uri image: [annotation records]}
+        self.annotations = {}
+        # malformed rows of the csv
+        self.errors = []
         self.checkup = kwargs.get('checkup', False)
         try:
             self.df = pd.read_csv(self.file, **kwargs)
@@ -23,7 +49,7 @@ class DataAnnotations:
         self._file_annotations(self.df)
 
     def __len__(self):
-        return self.annotations
+        return len(self.annotations)
 
     def __getitem__(self, item):
         return self.annotations[item]
@@ -37,15 +63,35 @@ class DataAnnotations:
     def __iter__(self):
         """
         iterate on dict with generators
-        :return: Tuples
+        :return: Tuples (uri image, list of annotation records)
         """
         self.n = 0
         yield from self.annotations.items()
 
     def _file_annotations(self, df: pd.DataFrame):
-        regroup = df.groupby('Reference.1')['Name'].apply(list)
-        for idx, values in regroup.items():
-            self.annotations[idx] = values
+        """
+        Parse the dataframe once, at loading, and group annotation records by canvas (col 'Reference.1').
+        :param df: DataFrame, csv of annotations
+        :return: None
+        """
+        records, self.errors = AnnotationIIIF.data_annotations(df)
+        # stable sort to keep csv order in each canvas
+        for record in sorted(records, key=lambda r: r['URI']):
+            self.annotations.setdefault(record['URI'], []).append(record)
+        self._report_errors()
+
+    def _report_errors(self):
+        """
+        Print one report of the malformed rows of the csv, not kept, and one of the annotations without tags, kept
+        (see AnnotationIIIF.data_annotations) (details in logs)
+        """
+        report_errors([error for error in self.errors if error.field != 'Tags'])
+        untagged = [error for error in self.errors if error.field == 'Tags']
+        if len(untagged) > 0:
+            for error in untagged:
+                logging.warning(f"Annotation '{error.name}' (row {error.row}), column {error.field}: {error.message}")
+            print(f"Warning: {len(untagged)} annotations without tags (built without tags). "
+                  f"Check the logfile to get details.")
 
     def _checkup(self):
         n = 0
@@ -56,11 +102,149 @@ class DataAnnotations:
         if n > 1:
             raise ValueError(f"You have {str(n)} columns with empty cells. You need to check your file.")
 
-    def get_row(self, uri: str, _id: str) -> pd.DataFrame:
-        return self.df.loc[(self.df['Name'] == _id) & (self.df['Reference.1'] == uri)]
-
     def get_uri(self):
-        return [annotation[0] for annotation in self.annotations]
+        return list(self.annotations)
 
     def get_type_analysis(self, _type: str) -> pd.DataFrame:
         return self.df.loc[(self.df['Character'] == _type)]
+
+
+def describe_image(path: str) -> dict:
+    """
+    Get width, height, format, byte size and content hash of a local image (run in a process pool).
+    :param path: str, local path
+    :return: dict
+    """
+    stat = os.stat(path)
+    with open(path, 'rb') as f:
+        size = get_image_size(f)
+        f.seek(0)
+        with Image.open(f) as img:
+            _format = img.format
+            if size is None:
+                size = img.size
+        f.seek(0)
+        digest = hashlib.sha256()
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return {'path': path, 'width': size[0], 'height': size[1], 'format': _format, 'size': stat.st_size,
+            'mtime': stat.st_mtime, 'sha256': digest.hexdigest()}
+
+
+class ScanMetadata:
+
+    def __init__(self, list_img: dict):
+        """
+        Metadata of all scan images of the project in one table, extracted at once from their names (see
+        FILENAME_RULES) : scanner, id of analysis, folio, label and element of each layer, and the fields of the rules
+        (limit, distance, objective, bands, derivative, processing, etc.).
+        :param list_img: dict, {remote name: (width, height)}
+        """
+        names = pd.Series(list(list_img), dtype=object)
+        scanners = '|'.join(sorted(SCANNERS, key=len, reverse=True))
+        df = pd.DataFrame({'id': names.str.extract(SCAN_ID, expand=False),
+                           'folio': names.str.extract(SCAN_FOLIO, expand=False),
+                           'extension': names.str.extract(r'\.([^.]*)$', expand=False).str.lower()})
+        df['scanner'] = df['id'].str.extract(f'^({scanners})_', expand=False)
+        df.index = pd.Index(names, dtype=object, name='filename')
+
+        tables = []
+        for family in dict.fromkeys(SCANNER_RULES.values()):
+            selected = df.index[df['scanner'].isin([s for s, f in SCANNER_RULES.items() if f == family])]
+            tables.append(PARSERS[family].table(pd.Series(selected, dtype=object)))
+        self.df = df.join(pd.concat(tables)) if tables else df
+
+    def __len__(self):
+        return len(self.df)
+
+    def get(self, analysis: str) -> dict:
+        """
+        :param analysis: str, scanner
+        :return: dict, {remote name: (label, element)} of the images of the analysis
+        """
+        df = self.df[self.df['scanner'] == analysis]
+        if 'label' not in df:
+            return {}
+        return dict(zip(df.index, zip(df['label'].fillna(''), df['element'].fillna(''))))
+
+    def validate(self) -> dict:
+        """
+        Check the names of all images before building the manifests
+        :return: dict, {remote name: reason} of the invalid names
+        """
+        df = self.df
+        if len(df) == 0:
+            return {}
+        reasons = pd.Series(pd.NA, index=df.index, dtype=object)
+        if 'valid' in df:
+            reasons = reasons.mask(df['valid'].eq(False), 'unknown chemical element')
+        reasons = reasons.mask(~df['extension'].isin(list(SequenceIIIF.formats)), 'unknown format')
+        reasons = reasons.mask(df['scanner'].isna(), 'unknown analysis')
+        reasons = reasons.mask(df.index.str.contains(' ', regex=False), 'space character')
+        return reasons.dropna().to_dict()
+
+
+class ImageIndex:
+
+    def __init__(self, filename=os.path.join(DATA_PATH, 'images_index.json')):
+        """
+        Sidecar index of the local images, keyed by their name on the server ({id}&{filename}).
+        Entries are computed again only if mtime or size of the file changed.
+        :param filename: str, json file
+        """
+        self.file = filename
+        try:
+            with open(self.file) as f:
+                self.images = json.load(f)
+        except (OSError, ValueError):
+            self.images = {}
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, item):
+        return self.images[item]
+
+    def __contains__(self, item):
+        return item in self.images
+
+    def _is_valid(self, name: str, path: str) -> bool:
+        entry = self.images.get(name)
+        if entry is None or entry['path'] != path:
+            return False
+        stat = os.stat(path)
+        return entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime
+
+    def update(self, images: dict, workers: int = None):
+        """
+        Describe new or modified images in a process pool and remove images not present anymore.
+        :param images: dict, {remote name: local path}
+        :param workers: int, number of processes (number of CPU by default)
+        :return: ImageIndex
+        """
+        todo = {name: path for name, path in images.items() if not self._is_valid(name, path)}
+        self.images = {name: entry for name, entry in self.images.items() if name in images}
+        if len(todo) > 0:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {name: executor.submit(describe_image, path) for name, path in todo.items()}
+                for name, future in futures.items():
+                    try:
+                        self.images[name] = future.result()
+                    except Exception as e:
+                        logging.error(f"Une erreur s'est produite : id: {str(name)} , {str(e)}", exc_info=True)
+        logging.info(f"Index of images: {len(self.images)} images ({len(todo)} updated)")
+        self.save()
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        with open(self.file + '.tmp', 'w') as f:
+            json.dump(self.images, f)
+        os.replace(self.file + '.tmp', self.file)
+
+    def get_sizes(self) -> dict:
+        """
+        Dimension of images with the same shape as Sftp.get_list_dir
+        :return: dict, {remote name: (width, height)}
+        """
+        return {name: (entry['width'], entry['height']) for name, entry in self.images.items()}
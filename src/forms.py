@@ -1,4 +1,6 @@
 import requests
+import numpy as np
+import pandas as pd
 from collections import namedtuple
 from PIL import Image
 from io import BytesIO
@@ -194,3 +196,149 @@ class Marker(FormSVG):
         # base 1:1 "M{str(self.x)},{str(self.y)}c0,-3.0303 1.51515,-6.06061 4.54545,-9.09091c0,-2.51039 -2.03507,-4.54545 -4.54545,-4.54545c-2.51039,0 -4.54545,2.03507 -4.54545,4.54545c3.0303,3.0303 4.54545,6.06061 4.54545,9.09091z" id="{self.id}" fill-opacity="0" fill="#00f000" stroke="{str("color")}" stroke-width="2" stroke-linecap="butt" stroke-linejoin="miter" stroke-miterlimit="10"/>"""
         # ICI base 20:20
         return f"""<path d="M{str(self.x)},{str(self.y)} c 0 -60.606 30.303 -121.2122 90.909 -181.8182 c 0 -50.2078 -40.7014 -90.909 -90.909 -90.909 c -50.2078 0 -90.909 40.7014 -90.909 90.909 c 60.606 60.606 90.909 121.2122 90.909 181.8182 z" fill-opacity="0" fill="#00f000" stroke="{str("color")}" stroke-width="2" stroke-linecap="butt" stroke-linejoin="miter" stroke-miterlimit="10"/>"""
+
+
+class AnnotationTable:
+    forms = {'RECTANGLE': Rectangle, 'MARKER': Marker}
+
+    def __init__(self, ids, types, x, y, w, h, image_w, image_h):
+        """
+        Columnar table of annotation forms (struct of arrays) to fit all coordinates in one vectorized step.
+        :param ids: list, id of annotations (col 'Name' in csv)
+        :param types: list, form of annotations ('rectangle' or 'marker')
+        :param x: array, coordinates x
+        :param y: array, coordinates y
+        :param w: array, coordinates w (width), ignored for markers
+        :param h: array, coordinates h (height), ignored for markers
+        :param image_w: array, width of the image annotated in AnnotateOn
+        :param image_h: array, height of the image annotated in AnnotateOn
+        """
+        self.id = np.asarray(ids, dtype=object)
+        self.type = np.array([str(_type).upper() for _type in types], dtype=object)
+        is_marker = self.type == 'MARKER'
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        # Marker has a fixed size
+        self.w = np.where(is_marker, 10, np.asarray(w, dtype=np.float64))
+        self.h = np.where(is_marker, 10, np.asarray(h, dtype=np.float64))
+        self.image_w = np.asarray(image_w, dtype=np.float64)
+        self.image_h = np.asarray(image_h, dtype=np.float64)
+        # canvas dimension, fixed with fit()
+        self.canvas_w = self.image_w
+        self.canvas_h = self.image_h
+
+    def __len__(self):
+        return len(self.id)
+
+    @classmethod
+    def from_records(cls, records: list):
+        """
+        Build table with annotation records (see AnnotationIIIF.data_annotations)
+        :param records: list of dict
+        :return: AnnotationTable
+        """
+        return cls(ids=[record['Name'] for record in records],
+                   types=[record['Type'] for record in records],
+                   x=[record['Coordinates']['x'] for record in records],
+                   y=[record['Coordinates']['y'] for record in records],
+                   w=[record['Coordinates']['w'] for record in records],
+                   h=[record['Coordinates']['h'] for record in records],
+                   image_w=[int(record['Dimensions']['width']) for record in records],
+                   image_h=[int(record['Dimensions']['height']) for record in records])
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, form: str = 'rectangle') -> tuple:
+        """
+        Build table with rows of the csv. All forms are considered as rectangle by default (scan area).
+        Rows with malformed dimensions or coordinates are not kept and are reported.
+        :param df: DataFrame, rows of the csv
+        :param form: str, form of the annotations
+        :return: AnnotationTable, list of ParseError(row, name, field, message) (see AnnotationIIIF.data_annotations)
+        """
+        ParseError = namedtuple('ParseError', ['row', 'name', 'field', 'message'])
+
+        dimensions = df['Dimensions'].astype(str).str.extract(r'^\s*(\d+)\s*x\s*(\d+)\s*$')
+        coordinates = df[['X', 'Y', 'W', 'H']].apply(pd.to_numeric, errors='coerce')
+        is_rectangle = form.upper() == 'RECTANGLE'
+
+        checks = {
+            'Dimensions': (dimensions[0].isna() | dimensions[1].isna(), "dimensions need to be 'width x height'"),
+            'X': (coordinates['X'].isna(), 'coordinate is not numeric'),
+            'Y': (coordinates['Y'].isna(), 'coordinate is not numeric'),
+            'W': (coordinates['W'].isna() & is_rectangle, 'coordinate is not numeric'),
+            'H': (coordinates['H'].isna() & is_rectangle, 'coordinate is not numeric'),
+        }
+        errors = []
+        malformed = pd.Series(False, index=df.index)
+        for field, (mask, message) in checks.items():
+            for row, name in df.loc[mask, 'Name'].items():
+                errors.append(ParseError(row=row, name=name, field=field, message=message))
+            malformed |= mask
+
+        valid = ~malformed.to_numpy()
+        table = cls(ids=df['Name'].to_numpy()[valid],
+                    types=[form] * int(valid.sum()),
+                    x=coordinates['X'].to_numpy()[valid],
+                    y=coordinates['Y'].to_numpy()[valid],
+                    w=coordinates['W'].to_numpy()[valid],
+                    h=coordinates['H'].to_numpy()[valid],
+                    image_w=pd.to_numeric(dimensions[0]).to_numpy()[valid],
+                    image_h=pd.to_numeric(dimensions[1]).to_numpy()[valid])
+        return table, errors
+
+    def fit(self, canvas_w, canvas_h):
+        """
+        To fit all forms with canvas dimension when it doesn't correspond to the dimension of the image in the csv.
+        Canvas dimension can be a scalar (one canvas) or an array by annotation (whole manuscript).
+        :param canvas_w: int or array, canvas width
+        :param canvas_h: int or array, canvas height
+        :return: AnnotationTable
+        """
+        self.canvas_w = np.broadcast_to(np.asarray(canvas_w, dtype=np.float64), self.x.shape)
+        self.canvas_h = np.broadcast_to(np.asarray(canvas_h, dtype=np.float64), self.x.shape)
+        redimension = (self.image_w != self.canvas_w) | (self.image_h != self.canvas_h)
+        ratio_w = self.canvas_w / self.image_w
+        ratio_h = self.canvas_h / self.image_h
+        is_marker = self.type == 'MARKER'
+
+        self.x = np.where(redimension, np.rint(self.x * ratio_w), self.x)
+        self.y = np.where(redimension, np.rint(self.y * ratio_h), self.y)
+        self.w = np.where(redimension & ~is_marker, np.rint(self.w * ratio_w), self.w)
+        self.h = np.where(redimension & ~is_marker, np.rint(self.h * ratio_h), self.h)
+        return self
+
+    @staticmethod
+    def _to_str(value: float) -> str:
+        return str(int(value)) if float(value).is_integer() else str(value)
+
+    def get_xywh(self, n: int) -> str:
+        """
+        :param n: int, position of annotation in the table
+        :return: str, x,y,w,h
+        """
+        return ','.join(self._to_str(value) for value in (self.x[n], self.y[n], self.w[n], self.h[n]))
+
+    def get_form(self, n: int) -> FormSVG:
+        """
+        Get form object with fitted coordinates
+        :param n: int, position of annotation in the table
+        :return: Rectangle or Marker
+        """
+        try:
+            form = self.forms[self.type[n]]
+        except KeyError:
+            raise ValueError("The data annotation type need to be 'rectangle' or 'marker'")
+        x, y, w, h = (int(v) if float(v).is_integer() else v for v in (self.x[n], self.y[n], self.w[n], self.h[n]))
+        if form is Rectangle:
+            return Rectangle(_id=self.id[n], x=x, y=y, w=w, h=h, verbose=False)
+        return Marker(_id=self.id[n], image_url=None, x=x, y=y, verbose=False)
+
+    def get_svg(self, n: int) -> str:
+        """
+        to build <svg> balise with the form of the annotation
+        :param n: int, position of annotation in the table
+        :return: str, <svg> html
+        """
+        tag = self.get_form(n).get_svg()
+        width, height = self._to_str(self.canvas_w[n]), self._to_str(self.canvas_h[n])
+        return f"""<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="{width}" height="{height}" xmlns:xlink="http://www.w3.org/1999/xlink">{tag}</svg>"""
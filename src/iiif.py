@@ -1,15 +1,13 @@
-import re
 import pandas as pd
-import requests
 import yaml
 from collections import namedtuple
-from urllib.parse import urlparse
 from yaml.loader import SafeLoader
 from iiif_prezi3 import Manifest, KeyValueString, config, ExternalItem, ResourceItem
 
 from src.opt.variables import DOMAIN_IIIF_HTTPS, ENDPOINT_API_IMG_3, ENDPOINT_API_IMG_2, ENDPOINT_MANIFEST
-from src.opt.data_variables import PERIODIC_TAB_FR
-from .forms import Rectangle, Marker
+from src.srv.fetch import FETCHER, REGISTRY
+from .forms import AnnotationTable
+from .rules import PARSERS
 
 
 # https://iiif-prezi.github.io/iiif-prezi3/recipes/0019-html-in-annotations/
@@ -36,10 +34,17 @@ class IIIF(object):
 
     def _get_manifest(self):
         """
-        Request http of API Manifest
+        Get json of the document, fetched and parsed at most once by run (see REGISTRY)
+        :return: json request
+        """
+        return REGISTRY.resolve(self.uri, self._request_manifest)
+
+    def _request_manifest(self):
+        """
+        Request http of API Manifest (with the shared pooled session, or the result of the prefetch)
         :return:json request
         """
-        iiif = requests.get(self.uri, allow_redirects=True)
+        iiif = FETCHER.get(self.uri)
         if 200 <= iiif.status_code < 400:
             return iiif.json()
         else:
@@ -80,6 +85,8 @@ class ManifestIIIF(IIIF):
         # Variable for new manifest
         self.uri_basename = self._build_uri_basename()
         self.uri_manifest = self._build_uri()
+        # Hash index of original canvases (image, canvas and service ids)
+        self.index = REGISTRY.resolve(('index', self.uri), self._build_index)
 
     def _print_json(self):
         return self.manifest.json(indent=2, ensure_ascii=False)
@@ -103,10 +110,64 @@ class ManifestIIIF(IIIF):
             print("Getting metadata!")
         return self.json['metadata']
 
-    def get_canvas(self, url_image: list):
-        for canvas in self.json['sequences'][0]['canvases']:
-            if canvas['images'][0]['resource']['@id'] == url_image:
-                self.canvases[canvas['images'][0]['resource']['@id']] = canvas
+    def _build_index(self) -> dict:
+        """
+        Build a hash index of the canvases of the original manifest, once at loading.
+        Works with API Presentation 2.x ('sequences') and 3.0 ('items').
+        :return: dict, {image resource id | canvas id | service id: canvas}
+        """
+        if 'sequences' in self.json:
+            canvases = [canvas for sequence in self.json['sequences'] for canvas in sequence.get('canvases', [])]
+        else:
+            canvases = self.json.get('items', [])
+
+        index = {}
+        for canvas in canvases:
+            for _id in self._get_canvas_ids(canvas):
+                # keep the first canvas in case of duplicate id
+                index.setdefault(_id, canvas)
+        return index
+
+    @staticmethod
+    def _get_canvas_ids(canvas: dict) -> list:
+        """
+        Get all ids linked to a canvas : canvas, image resources and their services.
+        :param canvas: dict, canvas of the original manifest
+        :return: list of str
+        """
+        def get_id(item):
+            if isinstance(item, dict):
+                return item.get('@id', item.get('id'))
+            return item
+
+        def get_services(item):
+            service = item.get('service', []) if isinstance(item, dict) else []
+            return service if isinstance(service, list) else [service]
+
+        # API Presentation 2.x : canvas > images > resource
+        resources = [image.get('resource', {}) for image in canvas.get('images', [])]
+        # API Presentation 3.0 : canvas > annotation page > annotation > body
+        for page in canvas.get('items', []):
+            for annotation in page.get('items', []):
+                body = annotation.get('body', {})
+                resources.extend(body if isinstance(body, list) else [body])
+
+        ids = [get_id(canvas)]
+        for resource in resources:
+            ids.append(get_id(resource))
+            ids.extend(get_id(service) for service in get_services(resource))
+        return [_id for _id in ids if _id is not None]
+
+    def get_canvas(self, url_image: str):
+        """
+        Get canvas of the original manifest with an image resource, canvas or service id.
+        :param url_image: str, id of image resource (or canvas, or service)
+        :return: dict, canvas or None
+        """
+        canvas = self.index.get(url_image)
+        if canvas is not None:
+            self.canvases[url_image] = canvas
+        return canvas
 
     def get_preconfig(self, filename):
         if self.verbose:
@@ -200,7 +261,7 @@ class ManifestIIIF(IIIF):
         """
 
         # Check if we registered any metadata complementary
-        if len(self.metadata) < 1:
+        if not self.metadata:
             self.metadata = None
         # Option personalisation url
         if url is None:
@@ -320,14 +381,23 @@ class ServicesIIIF(IIIF):
         :param uri: str, URI of the service linked to your ressource image.
         :param kwargs: verbose, server (see class IIIF)
         """
-        if not uri.endswith('info.json'):
-            uri = uri + '/info.json'
+        uri = self.build_uri_info(uri)
         try:
             super().__init__(uri=uri, **kwargs)
             self.get_api()
         except RuntimeError:
             print(('Impossible to access to the API image service.'))
 
+    @staticmethod
+    def build_uri_info(uri: str) -> str:
+        """
+        :param uri: str, URI of the service
+        :return: str, URI of info.json
+        """
+        if not uri.endswith('info.json'):
+            uri = uri + '/info.json'
+        return uri
+
     def get_info_image(self) -> namedtuple:
         """
         Get info service for api image.
@@ -357,18 +427,21 @@ class ServicesIIIF(IIIF):
 class AnnotationIIIF:
     xywh = None
 
-    def __init__(self, canvas: dict, data: dict, uri: str, **kwargs):
+    def __init__(self, canvas: dict, data: dict, uri: str, table: AnnotationTable = None, n: int = 0, **kwargs):
         """
 
         :param canvas:
         :param data:
         :param uri:
-        :param n:
+        :param table: AnnotationTable, fitted forms of the canvas (built for this annotation if None)
+        :param n: int, position of the annotation in the table
         :param kwargs:
         """
         self.data = data
         self.uri = uri
         self.canvas = canvas
+        self.table = table
+        self.n = n
         self.verbose = kwargs['verbose']
 
     def make_forms(self) -> str:
@@ -378,76 +451,76 @@ class AnnotationIIIF:
         :return: str, <svg> html
         """
         if isinstance(self.data['Type'], str):
-            # RECTANGLE
-            if self.data['Type'].upper() == 'RECTANGLE':
-                rectangle = Rectangle(_id=self.data['Name'], image_url=self.uri, x=self.data['Coordinates']['x'],
-                                      y=self.data['Coordinates']['y'], w=self.data['Coordinates']['w'],
-                                      h=self.data['Coordinates']['h'], verbose=self.verbose)
-
-                # check dimension image and form
-                rectangle.image_size = (int(self.data['Dimensions']['width']), int(self.data['Dimensions']['height']))
-
-                rectangle.check_dim_manifest(canvas_h=self.canvas['images'][0]['resource']['height'],
-                                             canvas_w=self.canvas['images'][0]['resource']['width'])
-                dimension = rectangle.dim_img_origin if rectangle.dim_img_origin is not None else rectangle.image_size
-                # fit dimension
-                tag = rectangle.get_svg()
-                # get xywh dimension
-                self.xywh = str(rectangle.x) + ',' + str(rectangle.y) + ',' + str(rectangle.w) + ',' + str(rectangle.h)
-
-            # MARKER
-            elif self.data['Type'].upper() == 'MARKER':
-                marker = Marker(_id=self.data['Name'], image_url=self.uri, x=self.data['Coordinates']['x'],
-                                y=self.data['Coordinates']['y'], verbose=self.verbose)
-                # check dimension image and form
-                marker.image_size = (int(self.data['Dimensions']['width']),
-                                             int(self.data['Dimensions']['height']))
-
-                marker.check_dim_manifest(canvas_h=self.canvas['images'][0]['resource']['height'],
-                                          canvas_w=self.canvas['images'][0]['resource']['width'])
-                dimension = marker.dim_img_origin if marker.dim_img_origin is not None else marker.image_size
-                # fit dimension
-                tag = marker.get_svg()
-                # get xywh dimension
-                self.xywh = str(marker.x) + ',' + str(marker.y) + ',' + str(marker.w) + ',' + str(marker.h)
-            else:
-                raise ValueError("The data annotation type need to be 'rectangle' or 'marker'")
-            return f"""<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="{str(dimension[0])}" height="{str(dimension[1])}" xmlns:xlink="http://www.w3.org/1999/xlink">{tag}</svg>"""
+            if self.table is None:
+                self.table = AnnotationTable.from_records([self.data]).fit(
+                    canvas_w=self.canvas['images'][0]['resource']['width'],
+                    canvas_h=self.canvas['images'][0]['resource']['height'])
+                self.n = 0
+            svg = self.table.get_svg(self.n)
+            # get xywh dimension
+            self.xywh = self.table.get_xywh(self.n)
+            return svg
         else:
             raise TypeError('The data annotation type need to be string.')
 
     @classmethod
-    def data_annotation(cls, row: pd.DataFrame) -> dict:
-        """
-        Function to get data and build annotation object
-        :param row:
-        :return: dict
-        """
-        try:
-            tags = [tag.strip() for tag in row['Tags'].values[0].split(',')]
-        except (IndexError, AttributeError) as err:
-            print("!Error : " + row['Name'].values[0], ", " + str(err) + "!")
-            tags = None
-            pass
-        try:
-            return {
-                'Name': row['Name'].values[0],
-                'Type': row['Type'].values[0],
-                'Type_analysis': row['Character'].values[0],
-                'Tags': tags,
-                'Dimensions': {
-                    'width': row['Dimensions'].values[0].split('x')[0].strip(),
-                    'height': row['Dimensions'].values[0].split('x')[1].strip(),
-                },
-                'Identifier': row['Identifier'].values[0],
-                'Coordinates':
-                    {'x': row['X'].values[0], 'y': row['Y'].values[0], 'w': row['W'].values[0],
-                     'h': row['H'].values[0]},
-                'Value': row['Value'].values[0],
-                'URI': row['Reference.1'].values[0]
-            }
-        except Exception as err:
-            print(err)
+    def data_annotations(cls, df: pd.DataFrame) -> (list, list):
+        """
+        Parse the whole csv table with columnar operations : tags as lists, integer width/height from 'Dimensions'
+        ("W x H") and numeric X/Y/W/H.
+        Malformed rows are not kept and are reported.
+        :param df: DataFrame, csv of annotations
+        :return: list of annotation records (dict), list of ParseError(row, name, field, message)
+        """
+        ParseError = namedtuple('ParseError', ['row', 'name', 'field', 'message'])
+
+        # Tags 'a, b' -> ['a', 'b'] (NaN if no tags)
+        tags = df['Tags'].astype('string').str.replace(r'\s*,\s*', ',', regex=True).str.strip().str.split(',')
+        # Dimensions 'W x H' -> (W, H)
+        dimensions = df['Dimensions'].astype(str).str.extract(r'^\s*(\d+)\s*x\s*(\d+)\s*$')
+        width = pd.to_numeric(dimensions[0]).astype('Int64')
+        height = pd.to_numeric(dimensions[1]).astype('Int64')
+        # Coordinates
+        coordinates = df[['X', 'Y', 'W', 'H']].apply(pd.to_numeric, errors='coerce')
+        is_rectangle = df['Type'].astype(str).str.upper() == 'RECTANGLE'
+
+        checks = {
+            'Tags': (tags.isna(), 'no tags'),
+            'Dimensions': (width.isna() | height.isna(), "dimensions need to be 'width x height'"),
+            'X': (coordinates['X'].isna(), 'coordinate is not numeric'),
+            'Y': (coordinates['Y'].isna(), 'coordinate is not numeric'),
+            'W': (coordinates['W'].isna() & is_rectangle, 'coordinate is not numeric'),
+            'H': (coordinates['H'].isna() & is_rectangle, 'coordinate is not numeric'),
+            'Reference.1': (df['Reference.1'].isna(), 'no image reference'),
+        }
+        errors = []
+        malformed = pd.Series(False, index=df.index)
+        for field, (mask, message) in checks.items():
+            for row, name in df.loc[mask, 'Name'].items():
+                errors.append(ParseError(row=row, name=name, field=field, message=message))
+            # Without tags, the annotation is still valid
+            if field != 'Tags':
+                malformed |= mask
+
+        valid = ~malformed.to_numpy()
+        columns = zip(df['Name'].to_numpy()[valid], df['Type'].to_numpy()[valid],
+                      df['Character'].to_numpy()[valid], tags.to_numpy()[valid],
+                      width.to_numpy()[valid], height.to_numpy()[valid], df['Identifier'].to_numpy()[valid],
+                      coordinates['X'].to_numpy()[valid], coordinates['Y'].to_numpy()[valid],
+                      coordinates['W'].to_numpy()[valid], coordinates['H'].to_numpy()[valid],
+                      df['Value'].to_numpy()[valid], df['Reference.1'].to_numpy()[valid])
+        records = [{
+            'Name': name,
+            'Type': _type,
+            'Type_analysis': character,
+            'Tags': _tags if isinstance(_tags, list) else None,
+            'Dimensions': {'width': int(w_img), 'height': int(h_img)},
+            'Identifier': identifier,
+            'Coordinates': {'x': x.item(), 'y': y.item(), 'w': w.item(), 'h': h.item()},
+            'Value': value,
+            'URI': uri
+        } for name, _type, character, _tags, w_img, h_img, identifier, x, y, w, h, value, uri in columns]
+        return records, errors
 
 
 class SequenceIIIF:
@@ -524,187 +597,44 @@ class SequenceIIIF:
         except KeyError:
             return None, None
 
-    def get_xywh(self, canvas, row, image_size):
+    def get_xywh(self, table: AnnotationTable, n: int) -> str:
         """
 
-        :param canvas: Canvas, canvas image configuration
-        :param row: Dataframe, row selected of value
-        :param image_size: tuple, (width, height)
-        :return: str, w,x,y,h
+        :param table: AnnotationTable, rows of the analysis fitted on their canvas
+        :param n: int, position of the row in the table
+        :return: str, x,y,w,h
         """
-
-        rectangle = Rectangle(_id=row['Name'], x=row['X'], y=row['Y'],
-                              w=row['W'], h=row['H'], verbose=self.verbose)
-
-        rectangle.image_size = image_size
-        # check dimension image and form and fit
-        rectangle.check_dim_manifest(canvas_h=canvas.height,
-                                     canvas_w=canvas.width)
-        # get xywh dimension
-        return str(rectangle.x) + ',' + str(rectangle.y) + ',' + str(rectangle.w) + ',' + str(rectangle.h)
+        return table.get_xywh(n)
 
     @staticmethod
-    def get_mtda_xrf(url: str) -> (list, str):
+    def get_mtda_xrf(filename: str) -> (str, str):
         """
-        To get metadata for XRF scanning in image title.
+        To get metadata for XRF scanning in image title (see FILENAME_RULES).
         example:
         sXRF_3&MS59_f1V_zoomx-deconv_Fe.tif
         sXRF_4&Map_data-Ms59-f2-deconv-Cu-lim255.tif
         sXRF_5&Ms59-f13v_deconv_sansHg-Cu.tif
 
-        :param url: url: str, url of image
-        :return: List of metadata, string Chemical Element ID
-        """
-        # list of metadata
-        mtda = []
-        element = 'unknow'
-
-        url_parse = urlparse(url).path
-
-        # compile
-        el_chem = re.compile(r'_([A-Z][a-z]?)')  # get group1
-        without_el = re.compile(r'sans([A-Z][a-z]?)-([A-Z][a-z]?)')
-        lim = re.compile(r'lim(\d+)')
-
-        # searcher
-        el_chem_match = el_chem.search(url_parse)
-        without_el_match = without_el.search(url_parse)
-        lim_match = lim.search(url_parse)
-
-        # getting methodology
-        if url_parse.find('deconv'):
-            mtda.append('Méthodologie: ' + 'Déconvolution')
-        # getting elements
-        if el_chem_match:
-            element = el_chem_match.group(1)
-            mtda.append(f'Élement chimique: {PERIODIC_TAB_FR[element]} ({element})')
-        # get without element (Hg-sans-Cu) -> Cu
-        elif without_el_match:
-            el_without_txt = without_el_match.group(2)
-            eliminated = without_el_match.group(1)
-            element = el_without_txt + "_without_" + eliminated
-            mtda.append(f'Élement chimique: {PERIODIC_TAB_FR[el_without_txt]} ({el_without_txt}) \n'
-                        f'Élimination: {PERIODIC_TAB_FR[eliminated]} ({eliminated})')
-        # getting limits
-        if lim_match:
-            limit = lim_match.group(1)
-            mtda.append(f'Limite (par coups): {limit}')
-            element += f'_lim_{limit}'
-
-        return mtda, element
+        :param filename: str, name of image
+        :return: str, metadata joined by ' | ', string Chemical Element ID
+        """
+        return PARSERS['xrf'].parse(filename)
 
     @staticmethod
-    def get_mtda_hs(url: str) -> list:
-        """
-        To get metadata for Hyperspectral scanning in image title.
-
-        exemple of urls
-        https://192.168.122.28:8183/iiif/3/HS_SWIR_5&Ms59-f42-obj56-frame100-dist43-SWIR_kubelkamunk-unmix_rule_rouge_noirci.png/full/max/0/default.tif
-        https://192.168.122.28:8183/iiif/3/HS_VNIR_6&Ms59-f53v-obj23-frame100-1_derivate5-1-2-grey-band237-456-75-contraste.png/full/max/0/default.tif
-        https://192.168.122.28:8183/iiif/3/HS_VNIR_1&Ms59-f1v-obj23-frame100-1_refl_mnf4.png/full/max/0/default.tif
-        https://192.168.122.28:8183/iiif/3/HS_SWIR_2&Ms59-f2-obj56-frame100-dist43-SWIR-1_continuum_removal-61-115-1-s-MTMF_blanc_pb.png/full/max/0/default.tif
-
-        :param url: str, url of image
-        :return: list, all elements to aggregate
-        """
-
-        # list mtda
-        mtda = []
-        element = 'unknow'
-
-        # No chemical element, so lower
-        url_parse = urlparse(url).path.lower()
-
-        # distance (object / lens)
-        dist = re.compile(r'dist(\d+)')
-        dist_match = dist.search(url_parse)
-        if dist_match:
-            mtda.append(f"Distance (objet/objectif): {dist_match.group(1)}")
-            element += f'dist_{dist_match.group(1)}'
-
-        # Reference spectrum
-        objet = url_parse.split('_')[-1].split('.')[0]
-        element = objet
-        if not objet.startswith(('derivate', 'mnf', 'pca')):
-            try:
-                mtda.append(f"Spectre de référence: {objet.replace('-', ' ')}")
-            except IndexError:
-                mtda.append(f"Spectre de référence: {objet.replace('-', ' ')}")
-
-
-        # Mapping processing (can have multiple processing)
-        techs = {'_mtmf_': 'Mixture Tuned Matched Filtering',
-                 '_sam_': 'Spectral Angle Mapper',
-                 '_sff_': 'Spectral Feature Fitting',
-                 '_unmix_': 'Unmixing',
-                 '_kubelkamunk_': 'kubelkamunk'}
-
-        n_tech = []
-        for tech_key, tech_name in techs.items():
-            if tech_key in url_parse:
-                n_tech.append(tech_name)
-                element += f'-{tech_key.replace("_", "")}'
-        if len(n_tech) < 0:
-            mtda.append(f"Traitements pour la cartographie: {', '.join(n_tech)}")
-
-        # Lens focal length (mm)
-        obj = re.compile(r'obj(\d+)')
-        obj_match = obj.search(url_parse)
-        if dist_match:
-            mtda.append(f"Objectif (mm): {obj_match.group(1)}")
-
-        # Band numbers
-        band = re.compile(r'band(\d+)(-\d+)*')
-        band_match = band.search(url_parse)
-        if band_match:
-            band_list = (band_match.group(0).replace('band', '').split('-'))
-            mtda.append(f"Numéros de bandes: {', '.join(band_list)}")
-
-        # Derivate
-        deriv = re.compile(r'derivate(\d+)-(\d+)-(\d+)')
-        deriv_match = deriv.search(url_parse)
-        if deriv_match:
-            mtda.append(
-                f"Dérivé (algorithme de Savitzky-Golay): {deriv_match.group(1)}, {deriv_match.group(2)}, {deriv_match.group(3)}")
-
-        # Color
-        if 'grey' in url_parse:
-            if 'contraste' in url_parse:
-                mtda.append('Couleur: Nuances de gris, contraste')
-            else:
-                mtda.append('Couleur: Nuances de gris')
-        elif 'rgb' in url_parse:
-            if 'contraste' in url_parse:
-                mtda.append('Couleur: RGB, contraste')
-            else:
-                mtda.append('Couleur: RGB')
-
-        # Statistical processing
-        stat = re.compile(r'(mnf|pca)(\d+)')
-        stat_match = stat.search(url_parse)
-        if stat_match:
-            mtda.append(f"Traitement statistique: {stat_match.group(1)} {stat_match.group(2)}")
-
-        # Pixel aggregation
-        if 'pixel_aggregate' in url_parse:
-            mtda.append('Aggrégation de pixels: Oui')
-            element += '_AggregPx'
-        else:
-            mtda.append('Aggrégation de pixels: Non')
-
-        # Subtracting the baseline
-        continuum = re.compile(r'continuum_removal-(\d+)-(\d+)(-1-s)?')
-        continuum_match = continuum.search(url_parse)
-        if continuum_match:
-            try:
-                continuum_match.groups(3)
-                mtda.append(
-                    f"Soustraction de la ligne de base: Entre {continuum_match.group(1)} et {continuum_match.group(2)} (spectres rendus positifs).")
-            except IndexError:
-                mtda.append(
-                    f"Soustraction de la ligne de base: Entre {continuum_match.group(1)} et {continuum_match.group(2)}.")
-
-        return mtda, element
+    def get_mtda_hs(filename: str) -> (str, str):
+        """
+        To get metadata for Hyperspectral scanning in image title (see FILENAME_RULES).
+
+        exemple of names
+        HS_SWIR_5&Ms59-f42-obj56-frame100-dist43-SWIR_kubelkamunk-unmix_rule_rouge_noirci.png
+        HS_VNIR_6&Ms59-f53v-obj23-frame100-1_derivate5-1-2-grey-band237-456-75-contraste.png
+        HS_VNIR_1&Ms59-f1v-obj23-frame100-1_refl_mnf4.png
+        HS_SWIR_2&Ms59-f2-obj56-frame100-dist43-SWIR-1_continuum_removal-61-115-1-s-MTMF_blanc_pb.png
+
+        :param filename: str, name of image
+        :return: str, metadata joined by ' | ', string ID of the layer
+        """
+        return PARSERS['hs'].parse(filename)
 
     def get_mtda_msp(self, url: str):
         """
@@ -444,3 +444,58 @@ PERIODIC_TAB_EN = {
     'Ts': 'Tennessine',
     'Og': 'Oganesson'
 }
+
+# Grammar of the names of scan images (see src.rules.FilenameParser), by family of analysis.
+# A rule matches if the name contains all 'contains' and the regex 'pattern' is found. Its 'label' is added to the
+# metadata, 'element' replaces the id of the layer and 'suffix' is appended to it. In templates, {gN} is the group N,
+# {eN} the french name of the chemical element of group N, {wN} the group N with spaces, {lN} the list of group N.
+# 'field' is the column of the rule in the table of scan metadata (its groups joined by '-', or a flag).
+# Only the first matching rule of a 'choice' is applied. Labels of a 'collect' are joined in one label.
+FILENAME_RULES = {
+    'xrf': {'lower': False,
+            'element': 'unknow',
+            'rules': [{'contains': 'deconv', 'field': 'deconvolution', 'label': 'Méthodologie: Déconvolution'},
+                      {'pattern': r'_([A-Z][a-z]?)', 'choice': 'element',
+                       'label': 'Élement chimique: {e1} ({g1})', 'element': '{g1}'},
+                      {'pattern': r'sans([A-Z][a-z]?)-([A-Z][a-z]?)', 'choice': 'element',
+                       'label': 'Élement chimique: {e2} ({g2}) \nÉlimination: {e1} ({g1})',
+                       'element': '{g2}_without_{g1}'},
+                      {'pattern': r'lim(\d+)', 'field': 'limit',
+                       'label': 'Limite (par coups): {g1}', 'suffix': '_lim_{g1}'}]},
+    'hs': {'lower': True,
+           'element': 'unknow',
+           'collect': {'processing': 'Traitements pour la cartographie: {values}'},
+           'rules': [{'pattern': r'dist(\d+)', 'field': 'distance', 'label': 'Distance (objet/objectif): {g1}'},
+                     # reference spectrum : last part of the name
+                     {'pattern': r'^(?:.*_)?([^_.]*)[^_]*$', 'element': '{g1}'},
+                     {'pattern': r'^(?:.*_)?(?!derivate|mnf|pca)([^_.]*)[^_]*$',
+                      'label': 'Spectre de référence: {w1}'},
+                     {'contains': '_mtmf_', 'field': 'mtmf', 'collect': 'processing',
+                      'label': 'Mixture Tuned Matched Filtering', 'suffix': '-mtmf'},
+                     {'contains': '_sam_', 'field': 'sam', 'collect': 'processing',
+                      'label': 'Spectral Angle Mapper', 'suffix': '-sam'},
+                     {'contains': '_sff_', 'field': 'sff', 'collect': 'processing',
+                      'label': 'Spectral Feature Fitting', 'suffix': '-sff'},
+                     {'contains': '_unmix_', 'field': 'unmix', 'collect': 'processing',
+                      'label': 'Unmixing', 'suffix': '-unmix'},
+                     {'contains': '_kubelkamunk_', 'field': 'kubelkamunk', 'collect': 'processing',
+                      'label': 'kubelkamunk', 'suffix': '-kubelkamunk'},
+                     {'pattern': r'obj(\d+)', 'field': 'objective', 'label': 'Objectif (mm): {g1}'},
+                     {'pattern': r'band(\d+(?:-\d+)*)', 'field': 'bands', 'label': 'Numéros de bandes: {l1}'},
+                     {'pattern': r'derivate(\d+)-(\d+)-(\d+)', 'field': 'derivative',
+                      'label': 'Dérivé (algorithme de Savitzky-Golay): {g1}, {g2}, {g3}'},
+                     {'contains': ['grey', 'contraste'], 'choice': 'color',
+                      'label': 'Couleur: Nuances de gris, contraste'},
+                     {'contains': 'grey', 'choice': 'color', 'label': 'Couleur: Nuances de gris'},
+                     {'contains': ['rgb', 'contraste'], 'choice': 'color', 'label': 'Couleur: RGB, contraste'},
+                     {'contains': 'rgb', 'choice': 'color', 'label': 'Couleur: RGB'},
+                     {'pattern': r'(mnf|pca)(\d+)', 'field': 'statistics',
+                      'label': 'Traitement statistique: {g1} {g2}'},
+                     {'contains': 'pixel_aggregate', 'choice': 'aggregate', 'field': 'aggregate',
+                      'label': 'Aggrégation de pixels: Oui', 'suffix': '_AggregPx'},
+                     {'choice': 'aggregate', 'label': 'Aggrégation de pixels: Non'},
+                     {'pattern': r'continuum_removal-(\d+)-(\d+)-1-s', 'choice': 'continuum', 'field': 'continuum',
+                      'label': 'Soustraction de la ligne de base: Entre {g1} et {g2} (spectres rendus positifs).'},
+                     {'pattern': r'continuum_removal-(\d+)-(\d+)', 'choice': 'continuum', 'field': 'continuum',
+                      'label': 'Soustraction de la ligne de base: Entre {g1} et {g2}.'}]},
+}
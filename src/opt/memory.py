@@ -0,0 +1,173 @@
+import os
+import gc
+import sys
+import types
+import logging
+import resource
+import threading
+import tracemalloc
+
+import pandas as pd
+
+from src.opt.variables import MEMORY_STREAM_RATIO, MEMORY_TOP_SITES
+
+# Shared objects not counted in deep sizes
+SKIP_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType,
+              types.CodeType, types.FrameType)
+
+
+def rss() -> int:
+    """
+    :return: int, resident memory of the process in bytes (peak of the process if /proc is not available)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def deep_sizeof(obj) -> int:
+    """
+    Size of an object and of all objects it refers to (each object counted once). DataFrame and Series are measured
+    by pandas with their strings.
+    :param obj: object
+    :return: int, bytes
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen or isinstance(item, SKIP_TYPES):
+            continue
+        seen.add(id(item))
+        if isinstance(item, pd.DataFrame):
+            size += int(item.memory_usage(deep=True, index=True).sum())
+            continue
+        if isinstance(item, pd.Series):
+            size += int(item.memory_usage(deep=True, index=True))
+            continue
+        size += sys.getsizeof(item)
+        stack.extend(gc.get_referents(item))
+    return size
+
+
+class MemoryMonitor:
+    def __init__(self):
+        """
+        Memory of the build. With tracing (tracemalloc), retained and peak memory of each stage of the profiler,
+        allocation sites and deep sizes of the main structures. With a budget, resident memory is checked between
+        canvases : output is streamed above MEMORY_STREAM_RATIO of the budget, and the build stops above the budget.
+        """
+        self.tracing = False
+        self.budget = None
+        self.streaming = False
+        self.stages = {}
+        self.sizes = {}
+        self.sites = []
+        self._stack = []
+        self._pid = None
+
+    def enable(self, trace: bool = False, budget: int = None):
+        """
+        :param trace: bool, trace allocations with tracemalloc (slower build)
+        :param budget: int, maximum resident memory in bytes (None without budget)
+        """
+        self.tracing = trace
+        self.budget = budget
+        self._pid = os.getpid()
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def enter(self, name: str):
+        """
+        Start of a stage (see Profiler.stage) : stages of the main thread only, memory of other threads is counted in
+        the stage running in the main thread.
+        :param name: str, stage
+        """
+        if not self.tracing or threading.current_thread() is not threading.main_thread():
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        if self._stack:
+            # peak of the parent stage before its reset
+            self._stack[-1][2] = max(self._stack[-1][2], peak)
+        tracemalloc.reset_peak()
+        self._stack.append([name, current, current])
+
+    def exit(self, name: str):
+        """
+        End of a stage
+        :param name: str, stage
+        """
+        if not self.tracing or threading.current_thread() is not threading.main_thread() or not self._stack:
+            return
+        _, start, peak = self._stack.pop()
+        current, last_peak = tracemalloc.get_traced_memory()
+        peak = max(peak, last_peak)
+        if self._stack:
+            self._stack[-1][2] = max(self._stack[-1][2], peak)
+        stage = self.stages.setdefault(name, {'count': 0, 'retained': 0, 'peak': 0})
+        stage['count'] += 1
+        stage['retained'] += current - start
+        stage['peak'] = max(stage['peak'], peak - start)
+
+    def snapshot(self, **objects):
+        """
+        Deep sizes of the structures and allocation sites of the memory retained at this step of the build
+        :param objects: {name: object}
+        """
+        if not self.tracing:
+            return
+        for name, obj in objects.items():
+            self.sizes[name] = deep_sizeof(obj)
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')])
+        self.sites = snapshot.statistics('lineno')[:MEMORY_TOP_SITES]
+
+    def check(self, writer=None) -> bool:
+        """
+        Check the resident memory against the budget : switch the writer (and the next ones) to stream mode above
+        MEMORY_STREAM_RATIO of the budget, stop the build above the budget.
+        :param writer: ManifestWriter, writer of the canvases being built
+        :return: bool, True if output must be streamed
+        """
+        if self.budget is None or os.getpid() != self._pid:
+            return self.streaming
+        used = rss()
+        if used > self.budget:
+            print(f"ERROR: memory {used / 1e6:.0f} MB over the budget of {self.budget / 1e6:.0f} MB. "
+                  f"Build stopped.")
+            logging.error(f"Une erreur s'est produite : mémoire {used} octets, budget {self.budget} octets")
+            sys.exit(1)
+        if not self.streaming and used > self.budget * MEMORY_STREAM_RATIO:
+            self.streaming = True
+            print(f"Memory {used / 1e6:.0f} MB over {MEMORY_STREAM_RATIO:.0%} of the budget : output is streamed.")
+            logging.warning(f"Memory {used} bytes : output is streamed.")
+        if self.streaming and writer is not None and not writer.stream:
+            writer.to_stream()
+        return self.streaming
+
+    def report(self):
+        """
+        Print memory by stage, deep sizes and allocation sites
+        """
+        if not self.tracing:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"Traced memory: {current / 1e6:.1f} MB (peak {peak / 1e6:.1f} MB), RSS {rss() / 1e6:.1f} MB")
+        print(f"{'stage':<12} {'count':>7} {'retained (MB)':>14} {'peak (MB)':>10}")
+        for name, stage in sorted(self.stages.items(), key=lambda item: item[1]['peak'], reverse=True):
+            print(f"{name:<12} {stage['count']:>7} {stage['retained'] / 1e6:>14.2f} {stage['peak'] / 1e6:>10.2f}")
+        for name, size in self.sizes.items():
+            print(f"The size of {name} is: {size / 1e6:.2f} MB.")
+        for stat in self.sites:
+            frame = stat.traceback[0]
+            print(f"{stat.size / 1e6:>8.2f} MB {stat.count:>9} blocks  {frame.filename}:{frame.lineno}")
+
+
+# Shared by all the stages of the run
+MEMORY = MemoryMonitor()
@@ -0,0 +1,159 @@
+import struct
+
+# Size of the blocks read in the file (each read of a remote file is a round-trip)
+BLOCK_SIZE = 16384
+# Maximum bytes read to find the dimension (JPEG with big metadata)
+MAX_READ = 4 * 1024 * 1024
+
+
+class RangeReader:
+    def __init__(self, f, block_size: int = BLOCK_SIZE):
+        """
+        Ranged reads on a file object (local or SFTP) with a cache of blocks.
+        :param f: file object opened in binary mode, with seek()
+        :param block_size: int
+        """
+        self.f = f
+        self.block_size = block_size
+        self.blocks = {}
+
+    def _block(self, n: int) -> bytes:
+        if n not in self.blocks:
+            if (n + 1) * self.block_size > MAX_READ:
+                raise ValueError('Dimension not found in the header')
+            self.f.seek(n * self.block_size)
+            self.blocks[n] = self.f.read(self.block_size)
+        return self.blocks[n]
+
+    def read(self, offset: int, length: int) -> bytes:
+        """
+        :param offset: int, position in the file
+        :param length: int, number of bytes
+        :return: bytes (shorter at the end of file)
+        """
+        data = b''
+        while length > 0:
+            n, start = divmod(offset, self.block_size)
+            block = self._block(n)[start:start + length]
+            if not block:
+                break
+            data += block
+            offset += len(block)
+            length -= len(block)
+        return data
+
+    def unpack(self, fmt: str, offset: int) -> tuple:
+        size = struct.calcsize(fmt)
+        data = self.read(offset, size)
+        if len(data) < size:
+            raise ValueError('Unexpected end of file')
+        return struct.unpack(fmt, data)
+
+
+def _png_size(reader: RangeReader) -> (int, int):
+    # signature (8) + length (4) + 'IHDR' (4) + width (4) + height (4)
+    return reader.unpack('>II', 16)
+
+
+def _jpeg_size(reader: RangeReader) -> (int, int):
+    offset = 2
+    while True:
+        marker, code = reader.unpack('>BB', offset)
+        if marker != 0xFF:
+            raise ValueError('Invalid JPEG marker')
+        # padding
+        if code == 0xFF:
+            offset += 1
+            continue
+        # markers without length
+        if code in (0x01, 0xD8) or 0xD0 <= code <= 0xD7:
+            offset += 2
+            continue
+        # Start Of Scan before a frame
+        if code in (0xD9, 0xDA):
+            raise ValueError('Dimension not found in the JPEG header')
+        length, = reader.unpack('>H', offset + 2)
+        # Start Of Frame (without DHT, JPG and DAC markers)
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            height, width = reader.unpack('>HH', offset + 5)
+            return width, height
+        offset += 2 + length
+
+
+def _tiff_size(reader: RangeReader) -> (int, int):
+    endian = '<' if reader.read(0, 2) == b'II' else '>'
+    version, = reader.unpack(endian + 'H', 2)
+    # TIFF or BigTIFF
+    if version == 42:
+        ifd, = reader.unpack(endian + 'I', 4)
+        n_entries, = reader.unpack(endian + 'H', ifd)
+        entry_size, entries, value_offset = 12, ifd + 2, 8
+    elif version == 43:
+        ifd, = reader.unpack(endian + 'Q', 8)
+        n_entries, = reader.unpack(endian + 'Q', ifd)
+        entry_size, entries, value_offset = 20, ifd + 8, 12
+    else:
+        raise ValueError('Invalid TIFF version')
+    types = {3: 'H', 4: 'I', 16: 'Q'}
+
+    size = {}
+    for n in range(n_entries):
+        entry = entries + n * entry_size
+        tag, _type = reader.unpack(endian + 'HH', entry)
+        # ImageWidth, ImageLength
+        if tag in (256, 257) and _type in types:
+            size[tag], = reader.unpack(endian + types[_type], entry + value_offset)
+            if len(size) == 2:
+                return size[256], size[257]
+    raise ValueError('Dimension not found in the TIFF header')
+
+
+def _jp2_size(reader: RangeReader) -> (int, int):
+    offset = 0
+    end = None
+    while end is None or offset < end:
+        length, box = reader.unpack('>I4s', offset)
+        header = 8
+        if length == 1:
+            length, = reader.unpack('>Q', offset + 8)
+            header = 16
+        # superbox : go inside
+        if box == b'jp2h':
+            end = offset + length
+            offset += header
+            continue
+        if box == b'ihdr':
+            height, width = reader.unpack('>II', offset + header)
+            return width, height
+        if length == 0:
+            break
+        offset += length
+    raise ValueError('Dimension not found in the JP2 header')
+
+
+def _j2k_size(reader: RangeReader) -> (int, int):
+    # SIZ marker after SOC : Lsiz, Rsiz, Xsiz, Ysiz, XOsiz, YOsiz
+    x_siz, y_siz, x_osiz, y_osiz = reader.unpack('>IIII', 8)
+    return x_siz - x_osiz, y_siz - y_osiz
+
+
+def get_image_size(f) -> (int, int) or None:
+    """
+    Get dimension of an image by reading only the minimum bytes of its header (TIFF IFD, PNG IHDR, JPEG SOF,
+    JP2 ihdr).
+    :param f: file object opened in binary mode, with seek()
+    :return: tuple (width, height) or None if the format is unknown
+    """
+    reader = RangeReader(f)
+    signature = reader.read(0, 12)
+    if signature.startswith(b'\x89PNG\r\n\x1a\n'):
+        return _png_size(reader)
+    if signature.startswith(b'\xff\xd8'):
+        return _jpeg_size(reader)
+    if signature[:4] in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'):
+        return _tiff_size(reader)
+    if signature == b'\x00\x00\x00\x0cjP  \r\n\x87\n':
+        return _jp2_size(reader)
+    if signature.startswith(b'\xff\x4f\xff\x51'):
+        return _j2k_size(reader)
+    return None
@@ -0,0 +1,197 @@
+import os
+import glob
+import json
+import math
+import time
+import cProfile
+import threading
+from contextlib import nullcontext
+
+# Returned by Profiler.stage when profiling is disabled
+NO_SPAN = nullcontext()
+
+
+class Span:
+    __slots__ = ('profiler', 'name', 'args', 'start')
+
+    def __init__(self, profiler, name: str, args: dict):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        if self.profiler.memory is not None:
+            self.profiler.memory.enter(self.name)
+        self.profiler._enter_cprofile(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.perf_counter()
+        self.profiler._exit_cprofile(self.name)
+        if self.profiler.memory is not None:
+            self.profiler.memory.exit(self.name)
+        self.profiler.add(self.name, self.start, end, self.args)
+
+
+class Profiler:
+    def __init__(self):
+        """
+        Timing of the stages of the build (fetch, csv, canvas, svg, serialize, upload, listing) and of each HTTP and
+        SFTP call. Disabled by default : a stage costs one test and returns a shared empty context.
+        """
+        self.enabled = False
+        self.spans = []
+        self.origin = time.perf_counter()
+        self.cprofile_stage = None
+        self._cprofile = None
+        self._depth = 0
+        self._threads = {}
+        self._lock = threading.Lock()
+        # MemoryMonitor accounting the memory of each stage (see src.opt.memory)
+        self.memory = None
+
+    def enable(self, cprofile_stage: str = None, memory=None):
+        """
+        :param cprofile_stage: str, stage to profile with cProfile (in the main thread), None to disable
+        :param memory: MemoryMonitor, to account the memory of each stage (None to disable)
+        """
+        self.memory = memory
+        self.enabled = True
+        self.spans = []
+        self._threads = {}
+        self.origin = time.perf_counter()
+        self.cprofile_stage = cprofile_stage
+        self._cprofile = cProfile.Profile() if cprofile_stage is not None else None
+
+    def stage(self, name: str, **args):
+        """
+        Time a stage : with PROFILER.stage('canvas'): ...
+        :param name: str, name of the stage
+        :param args: informations of the span in the trace (e.g. uri)
+        :return: context manager
+        """
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, args)
+
+    def add(self, name: str, start: float, end: float, args: dict = None):
+        """
+        Register a span
+        :param name: str, stage
+        :param start: float, time.perf_counter() at the start
+        :param end: float, time.perf_counter() at the end
+        :param args: dict
+        """
+        ident = (os.getpid(), threading.get_ident())
+        with self._lock:
+            if ident not in self._threads:
+                self._threads[ident] = (len(self._threads), threading.current_thread().name)
+            self.spans.append((name, start, end, ident[0], self._threads[ident][0], args))
+
+    def dump(self, filename: str):
+        """
+        Write spans of a worker process, to merge them in the parent (see merge)
+        :param filename: str
+        """
+        threads = [[pid, tid, name] for (pid, _), (tid, name) in self._threads.items()]
+        with open(filename, 'w') as f:
+            json.dump({'spans': self.spans, 'threads': threads}, f)
+
+    def merge(self, pattern: str):
+        """
+        Add spans of the worker processes and remove their files.
+        perf_counter is the monotonic clock of the system : spans of all processes are on the same timeline.
+        :param pattern: str, glob of files written by dump
+        """
+        for filename in glob.glob(pattern):
+            try:
+                with open(filename) as f:
+                    worker = json.load(f)
+                os.remove(filename)
+            except (OSError, ValueError):
+                continue
+            with self._lock:
+                tids = {}
+                for pid, tid, name in worker['threads']:
+                    tids[(pid, tid)] = len(self._threads)
+                    self._threads[(pid, f'worker-{tid}')] = (len(self._threads), name)
+                self.spans.extend((name, start, end, pid, tids[(pid, tid)], args)
+                                  for name, start, end, pid, tid, args in worker['spans'])
+
+    def _enter_cprofile(self, name: str):
+        if name == self.cprofile_stage and threading.current_thread() is threading.main_thread():
+            # nested spans of the same stage are profiled once
+            if self._depth == 0:
+                self._cprofile.enable()
+            self._depth += 1
+
+    def _exit_cprofile(self, name: str):
+        if name == self.cprofile_stage and threading.current_thread() is threading.main_thread():
+            self._depth -= 1
+            if self._depth == 0:
+                self._cprofile.disable()
+
+    @staticmethod
+    def _percentile(values: list, p: float) -> float:
+        # nearest rank on sorted values
+        return values[max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))]
+
+    def summary(self) -> dict:
+        """
+        :return: dict, {stage: {count, total, p50, p95, max}} in seconds, by total time
+        """
+        durations = {}
+        for name, start, end, _, _, _ in self.spans:
+            durations.setdefault(name, []).append(end - start)
+        stages = {}
+        for name, values in durations.items():
+            values.sort()
+            stages[name] = {'count': len(values),
+                            'total': sum(values),
+                            'p50': self._percentile(values, 50),
+                            'p95': self._percentile(values, 95),
+                            'max': values[-1]}
+        return dict(sorted(stages.items(), key=lambda item: item[1]['total'], reverse=True))
+
+    def trace(self) -> dict:
+        """
+        :return: dict, Chrome trace events (chrome://tracing, Perfetto)
+        """
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                  for (pid, _), (tid, name) in self._threads.items()]
+        for name, start, end, pid, tid, args in self.spans:
+            event = {'name': name, 'cat': name.split('.')[0], 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': round((start - self.origin) * 1e6, 3), 'dur': round((end - start) * 1e6, 3)}
+            if args:
+                event['args'] = args
+            events.append(event)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, prefix: str) -> dict:
+        """
+        Write {prefix}.summary.json, {prefix}.trace.json and {prefix}.prof (cProfile of a stage).
+        :param prefix: str, path and prefix of files
+        :return: dict, summary
+        """
+        if os.path.dirname(prefix):
+            os.makedirs(os.path.dirname(prefix), exist_ok=True)
+        self.merge(prefix + '.worker-*.json')
+        summary = self.summary()
+        with open(prefix + '.summary.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+        with open(prefix + '.trace.json', 'w') as f:
+            json.dump(self.trace(), f)
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(prefix + '.prof')
+
+        print(f"{'stage':<12} {'count':>7} {'total (s)':>10} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+        for name, stage in summary.items():
+            print(f"{name:<12} {stage['count']:>7} {stage['total']:>10.3f} {stage['p50'] * 1e3:>9.2f} "
+                  f"{stage['p95'] * 1e3:>9.2f}")
+        return summary
+
+
+# Shared by all the stages of the run
+PROFILER = Profiler()
@@ -1,6 +1,7 @@
 import matplotlib.colors as mcolors
 import random
 import os
+from bisect import bisect_left, bisect_right
 from urllib.parse import urlparse
 
 from path import CURRENT_PATH
@@ -30,6 +31,54 @@ def check_img_validity(filename: str) -> bool:
     :return:
     """
     return all(element.lower() not in filename.lower() for element in USEFULL_SCAN)
+
+
+class PrefixIndex:
+    # Separator between id of analysis and filename on the server : {id}&{filename}
+    separator = '&'
+
+    def __init__(self, names):
+        """
+        Sorted index of remote image names to find the files of an analysis id in logarithmic time.
+        Names without match and ambiguous names (id prefix of another id, e.g. sXRF_1 and sXRF_10) are reported.
+        :param names: iterable of str, names of images (keys of Sftp.get_list_dir)
+        """
+        self.names = sorted(names)
+        self.unmatched = []
+        self.ambiguous = []
+
+    def view(self):
+        """
+        Index on the same sorted names with its own reports (one by analysis)
+        :return: PrefixIndex
+        """
+        index = PrefixIndex(())
+        index.names = self.names
+        return index
+
+    def match(self, prefix: str) -> list:
+        """
+        :param prefix: str
+        :return: list of names starting by prefix
+        """
+        return self.names[bisect_left(self.names, prefix):bisect_right(self.names, prefix + chr(0x10FFFF))]
+
+    def lookup(self, name: str) -> list:
+        """
+        Get files of an analysis id : exact id ({name}&...), or names starting by the id if there is no exact id.
+        :param name: str, id of analysis (col 'Name' in csv)
+        :return: list of names
+        """
+        exact = self.match(name + self.separator)
+        loose = self.match(name)
+        if len(loose) == 0 and name not in self.unmatched:
+            self.unmatched.append(name)
+        elif len(exact) == 0 and name not in self.ambiguous and \
+                len({_name.split(self.separator)[0] for _name in loose}) > 1:
+            self.ambiguous.append(name)
+        return exact if len(exact) > 0 else loose
+
+
 class Color:
     def __init__(self, list_color):
         self.list_color = list_color
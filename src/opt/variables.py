@@ -6,6 +6,11 @@ SCANNERS = {'sXRF': 'Scanner de Spectrométrie par Fluorescence des rayons X',
             'HS_SWIR': 'Hyperspectral Infrarouge Court',
             'HS_VNIR': 'Hyperspectral Visible et Proche Infrarouge',
             'MSP': 'Image Multispectrale'}
+# Grammar of the names of scan images by scanner (see FILENAME_RULES)
+SCANNER_RULES = {'sXRF': 'xrf', 'HS_SWIR': 'hs', 'HS_VNIR': 'hs'}
+# Id of analysis and folio in the names of scan images ({id}&{filename})
+SCAN_ID = r'^([^&]*)&'
+SCAN_FOLIO = r'[-_&][fF](\d+[rvRV]?)(?![a-zA-Z])'
 
 #### USEFULL ####
 
@@ -13,6 +18,8 @@ USEFULL_SCAN = ['video']
 
 #### LINKS ####
 # IIIF Manifest
+SOURCE_MANIFEST = 'https://emmsm.unicaen.fr/manifests/Avranches_BM_59.json'
+SOURCE_MANIFEST_SCANNERS = 'https://crc-centre-recherche-conservation.github.io/iiif/iiif/manifest/Avranches_BM_59.json'
 URI_CRC = "https://crc-centre-recherche-conservation.github.io/iiif/"
 ENDPOINT_MANIFEST = "iiif/manifest/"
 ENDPOINT_BASE = "iiif/"
@@ -88,5 +95,36 @@ IMPORTANT_COLUMNS = [
  "Resolution"
 ]
 
+#### OUTPUT ####
+# indent : indentation of json (None for minified json), precompress : write .gz and .br siblings
+OUTPUT_PROFILES = {'pretty': {'indent': 2, 'precompress': False},
+                   'compact': {'indent': None, 'precompress': True}}
 
+#### LOCALHOST SERVER ####
+# Viewers revalidate manifests on each load (304 if unchanged)
+CACHE_CONTROL = 'no-cache'
+SERVER_PORT = 8000
+# Seconds before closing an idle keep-alive connection
+SERVER_TIMEOUT = 15
+# Precompressed variants of output files, by order of preference
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
 
+#### HTTP ####
+# Pool of workers to fetch IIIF documents (info.json, manifests)
+FETCH_WORKERS = 16
+# Maximum of concurrent requests by host
+FETCH_PER_HOST = 8
+FETCH_TIMEOUT = 25
+# Persistent cache of HTTP GET (seconds / bytes)
+HTTP_CACHE_MAX_AGE = 12 * 3600
+HTTP_CACHE_SIZE = 512 * 1024 * 1024
+
+#### SFTP ####
+# Channels opened on the SSH transport shared by the build
+SFTP_CHANNELS = 4
+
+#### MEMORY ####
+# With --memory-budget, output is streamed above this part of the budget (RSS), and the build stops above the budget
+MEMORY_STREAM_RATIO = 0.6
+# Allocation sites reported by --usage-memory
+MEMORY_TOP_SITES = 10
@@ -0,0 +1,204 @@
+import re
+from string import Formatter
+
+import yaml
+import pandas as pd
+from yaml.loader import SafeLoader
+
+from src.opt.data_variables import FILENAME_RULES, PERIODIC_TAB_FR
+
+
+def format_series(template: str, groups: pd.DataFrame) -> pd.Series:
+    """
+    Template of a rule formatted on all rows
+    :param template: str, see FILENAME_RULES
+    :param groups: DataFrame, column N is the group N (see Rule.extract)
+    :return: Series, NaN where a chemical element is unknown
+    """
+    result = pd.Series('', index=groups.index, dtype=object)
+    for text, field, _, _ in Formatter().parse(template):
+        result = result + text
+        if field is None:
+            continue
+        if field == 'values':
+            value = groups['values']
+        else:
+            kind, value = field[0], groups[int(field[1:])]
+            if kind == 'e':
+                value = value.map(PERIODIC_TAB_FR)
+            elif kind == 'w':
+                value = value.str.replace('-', ' ', regex=False)
+            elif kind == 'l':
+                value = value.str.replace('-', ', ', regex=False)
+        result = result + value
+    return result
+
+
+def join_series(values: list, sep: str, index: pd.Index) -> pd.Series:
+    """
+    Vectorized str.join of the values of each row, NaN are skipped
+    :param values: list of Series
+    :param sep: str
+    :param index: Index of the rows
+    :return: Series, NaN without values
+    """
+    joined = pd.Series(index=index, dtype=object)
+    for value in values:
+        value = value.astype(object)
+        joined = joined.where(joined.notna(), value).mask(joined.notna() & value.notna(), joined + sep + value)
+    return joined
+
+
+class Rule:
+    __slots__ = ('pattern', 'regex', 'contains', 'label', 'element', 'suffix', 'choice', 'collect', 'field')
+
+    def __init__(self, pattern: str = None, contains: str or list = None, label: str = None, element: str = None,
+                 suffix: str = None, choice: str = None, collect: str = None, field: str = None):
+        """
+        Rule of the grammar of filenames, compiled once (see FILENAME_RULES)
+        """
+        self.pattern = pattern
+        self.regex = re.compile(pattern) if pattern is not None else None
+        self.contains = (contains,) if isinstance(contains, str) else tuple(contains or ())
+        self.label = label
+        self.element = element
+        self.suffix = suffix
+        self.choice = choice
+        self.collect = collect
+        self.field = field
+
+    def extract(self, names: pd.Series) -> (pd.Series, pd.DataFrame):
+        """
+        Match of the rule on all filenames
+        :param names: Series of str, filenames
+        :return: Series of bool (rows matching the rule), DataFrame (column N is the group N, '' if not found)
+        """
+        mask = pd.Series(True, index=names.index)
+        for text in self.contains:
+            mask &= names.str.contains(text, regex=False)
+        if self.regex is None:
+            return mask, pd.DataFrame({0: ''}, index=names.index)
+        # group 0 is the whole match
+        groups = names.str.extract(f'({self.pattern})', expand=True)
+        mask &= groups[0].notna()
+        return mask, groups.fillna('')
+
+    def value(self, mask: pd.Series, groups: pd.DataFrame) -> pd.Series:
+        """
+        :return: Series, value of the field of the rule : its groups joined by '-' (NaN if not found), or a flag
+        """
+        if groups.shape[1] == 1:
+            return mask
+        value = groups[1]
+        for n in range(2, groups.shape[1]):
+            value = value + '-' + groups[n]
+        return value.where(mask)
+
+
+class FilenameParser:
+    def __init__(self, rules: list, lower: bool = False, element: str = 'unknow', collect: dict = None):
+        """
+        Metadata of scan images from their filename, extracted for many filenames at once (see table). Results are
+        kept by filename : on rebuilds, a filename already parsed costs a dictionary lookup (see parse).
+        :param rules: list of dict, see Rule
+        :param lower: bool, parse the filename in lowercase
+        :param element: str, id of the layer if no rule sets it
+        :param collect: dict, {collect: template of the label joining its values}
+        """
+        self.rules = [Rule(**rule) for rule in rules]
+        self.lower = lower
+        self.element = element
+        self.collect = collect or {}
+        self._cache = {}
+
+    def parse(self, filename: str) -> (str, str):
+        """
+        :param filename: str, name of the image (remote name)
+        :return: str, labels joined by ' | ', str, id of the layer
+        """
+        try:
+            return self._cache[filename]
+        except KeyError:
+            return self.parse_all([filename])[filename]
+
+    def parse_all(self, filenames) -> dict:
+        """
+        Parse all filenames in one call (e.g. the remote listing of a project) : filenames not parsed yet are
+        extracted in one table.
+        :param filenames: iterable of str
+        :return: dict, {filename: (labels joined by ' | ', id of the layer)}
+        """
+        filenames = list(filenames)
+        todo = [filename for filename in dict.fromkeys(filenames) if filename not in self._cache]
+        if len(todo) > 0:
+            self.table(pd.Series(todo, dtype=object))
+        return {filename: self._cache[filename] for filename in filenames}
+
+    def table(self, filenames: pd.Series) -> pd.DataFrame:
+        """
+        Parse many filenames at once.
+        :param filenames: Series of str
+        :return: DataFrame indexed by filename : 'label' (labels joined by ' | '), 'element', 'valid' (False if a
+        chemical element is unknown, without label) and a column by field of the rules. Label and element of each
+        filename are kept for parse.
+        """
+        names = pd.Series(filenames.values, dtype=object)
+        if self.lower:
+            names = names.str.lower()
+        table = pd.DataFrame(index=names.index)
+        element = pd.Series(self.element, index=names.index, dtype=object)
+        valid = pd.Series(True, index=names.index)
+        labels = []
+        chosen = {}
+        collected = {}
+        for rule in self.rules:
+            mask, groups = rule.extract(names)
+            if rule.choice is not None:
+                done = chosen.get(rule.choice, pd.Series(False, index=names.index))
+                mask &= ~done
+                chosen[rule.choice] = done | mask
+            if rule.field is not None:
+                value = rule.value(mask, groups)
+                table[rule.field] = value if rule.field not in table else value.where(mask, table[rule.field])
+            if rule.label is not None:
+                label = format_series(rule.label, groups).where(mask)
+                valid &= ~(mask & label.isna())
+                if rule.collect is None:
+                    labels.append(label)
+                elif rule.collect not in collected:
+                    # label at the place of the first value
+                    collected[rule.collect] = [label]
+                    labels.append(rule.collect)
+                else:
+                    collected[rule.collect].append(label)
+            if rule.element is not None:
+                element = element.mask(mask, format_series(rule.element, groups))
+            if rule.suffix is not None:
+                element = element.mask(mask, element + format_series(rule.suffix, groups))
+
+        for n, label in enumerate(labels):
+            if isinstance(label, str):
+                values = pd.DataFrame({'values': join_series(collected[label], ', ', names.index)})
+                labels[n] = format_series(self.collect[label], values)
+        table['label'] = join_series(labels, ' | ', names.index).fillna('').where(valid, '')
+        table['element'] = element.where(valid, self.element)
+        table['valid'] = valid
+        table.index = pd.Index(filenames.values, name='filename')
+        # single filenames parsed with the whole listing (see parse)
+        self._cache.update(zip(table.index, zip(table['label'], table['element'])))
+        return table
+
+
+def load_rules(rules: dict or str) -> dict:
+    """
+    :param rules: dict, see FILENAME_RULES, or str, path of a yaml file with the same structure
+    :return: dict, {family: FilenameParser}
+    """
+    if isinstance(rules, str):
+        with open(rules, encoding='utf-8') as f:
+            rules = yaml.load(f, Loader=SafeLoader)
+    return {family: FilenameParser(**table) for family, table in rules.items()}
+
+
+# Compiled at import, replaced by the rules of --filename-rules
+PARSERS = load_rules(FILENAME_RULES)
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import logging
+import threading
+import requests
+
+from path import CACHE_PATH
+from src.opt.variables import HTTP_CACHE_MAX_AGE, HTTP_CACHE_SIZE
+
+
+class HttpCache:
+    index_file = 'index.json'
+
+    def __init__(self, path: str = os.path.join(CACHE_PATH, 'http'), max_age: int = HTTP_CACHE_MAX_AGE,
+                 max_size: int = HTTP_CACHE_SIZE, offline: bool = False):
+        """
+        Persistent cache on disk of HTTP GET. Bodies are stored with their ETag and Last-Modified to revalidate
+        them with conditional requests.
+        :param path: str, cache directory
+        :param max_age: int, seconds during which a stored body is served without revalidation
+        :param max_size: int, size budget in bytes (least recently used bodies are evicted)
+        :param offline: bool, serve only from cache
+        """
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._modified = False
+        os.makedirs(self.path, exist_ok=True)
+        self.index = self._load_index()
+        atexit.register(self.save)
+
+    def _load_index(self) -> dict:
+        try:
+            with open(os.path.join(self.path, self.index_file)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        """
+        Write index of the cache on disk
+        """
+        with self._lock:
+            if not self._modified:
+                return
+            # temporary file by process (workers of --jobs share the cache)
+            tmp = os.path.join(self.path, f'{self.index_file}.{os.getpid()}.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(tmp, os.path.join(self.path, self.index_file))
+            self._modified = False
+
+    @staticmethod
+    def _key(uri: str) -> str:
+        return hashlib.sha256(uri.encode('utf-8')).hexdigest()
+
+    def _body_path(self, key: str) -> str:
+        return os.path.join(self.path, key + '.body')
+
+    def _read(self, key: str, uri: str) -> requests.Response or None:
+        """
+        Build response with stored body
+        """
+        try:
+            with open(self._body_path(key), 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+        with self._lock:
+            entry = self.index.get(key)
+            if entry is None:
+                # evicted by another thread while reading
+                return None
+            entry['accessed'] = time.time()
+            self._modified = True
+        response = requests.Response()
+        response.status_code = 200
+        response.url = uri
+        response._content = content
+        response.headers['Content-Type'] = entry.get('content_type') or 'application/json'
+        return response
+
+    def _store(self, key: str, uri: str, response: requests.Response):
+        with open(self._body_path(key), 'wb') as f:
+            f.write(response.content)
+        with self._lock:
+            now = time.time()
+            self.index[key] = {'uri': uri,
+                               'etag': response.headers.get('ETag'),
+                               'last_modified': response.headers.get('Last-Modified'),
+                               'content_type': response.headers.get('Content-Type'),
+                               'size': len(response.content),
+                               'stored': now,
+                               'accessed': now}
+            self._modified = True
+        self._evict()
+
+    def _evict(self):
+        """
+        Remove least recently used bodies above the size budget
+        """
+        with self._lock:
+            total = sum(entry['size'] for entry in self.index.values())
+            if total <= self.max_size:
+                return
+            for key in sorted(self.index, key=lambda k: self.index[k]['accessed']):
+                if total <= self.max_size:
+                    break
+                total -= self.index.pop(key)['size']
+                try:
+                    os.remove(self._body_path(key))
+                except OSError:
+                    pass
+
+    def get(self, uri: str, request) -> requests.Response:
+        """
+        Get response from cache, revalidate it if it is too old or request it.
+        :param uri: str
+        :param request: function(uri, headers) -> Response, to request the server
+        :return: Response
+        """
+        key = self._key(uri)
+        entry = self.index.get(key)
+
+        if entry is not None and (self.offline or time.time() - entry['stored'] < self.max_age):
+            response = self._read(key, uri)
+            if response is not None:
+                return response
+            entry = None
+        if self.offline:
+            raise requests.ConnectionError(f"Offline mode: '{uri}' is not in the cache.")
+
+        # Conditional request
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        response = request(uri, headers)
+
+        if response.status_code == 304 and entry is not None:
+            cached = self._read(key, uri)
+            if cached is not None:
+                with self._lock:
+                    entry['stored'] = time.time()
+                    self._modified = True
+                return cached
+            # Body lost, request it again
+            response = request(uri, {})
+        if 200 <= response.status_code < 300:
+            try:
+                self._store(key, uri, response)
+            except OSError as err:
+                logging.error(f"Une erreur s'est produite : cache: {str(uri)} , {str(err)}")
+        return response
+
+
+class FragmentStore:
+    # Version of the canvas builder : fragments of another version are rebuilt
+    version = 1
+
+    def __init__(self, name: str, path: str = os.path.join(CACHE_PATH, 'canvases')):
+        """
+        Local store of serialized canvases of a manifest, addressed by the fingerprint of their inputs, for
+        incremental builds : only canvases whose inputs changed are rebuilt.
+        :param name: str, name of the manifest
+        :param path: str, store directory
+        """
+        self.path = os.path.join(path, name)
+        self.used = set()
+        self.reused = 0
+        self.rebuilt = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def fingerprint(self, **inputs) -> str:
+        """
+        :param inputs: all inputs of a canvas (csv rows, source canvas, service info, configuration)
+        :return: str, sha256 of inputs
+        """
+        data = json.dumps({'version': self.version, **inputs}, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _fragment_path(self, fingerprint: str) -> str:
+        return os.path.join(self.path, fingerprint + '.json')
+
+    def has(self, fingerprint: str) -> bool:
+        return os.path.exists(self._fragment_path(fingerprint))
+
+    def get(self, fingerprint: str) -> str:
+        """
+        :param fingerprint: str, fingerprint of a stored canvas (see has)
+        :return: str, serialized canvas
+        """
+        self.used.add(fingerprint)
+        with open(self._fragment_path(fingerprint), encoding='utf-8') as f:
+            fragment = f.read()
+        self.reused += 1
+        return fragment
+
+    def put(self, fingerprint: str, fragment: str):
+        """
+        :param fingerprint: str
+        :param fragment: str, serialized canvas
+        """
+        self.used.add(fingerprint)
+        self.rebuilt += 1
+        tmp = self._fragment_path(fingerprint) + f'.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(fragment)
+            os.replace(tmp, self._fragment_path(fingerprint))
+        except OSError as err:
+            logging.error(f"Une erreur s'est produite : cache: {str(fingerprint)} , {str(err)}")
+
+    def prune(self):
+        """
+        Remove fragments not used by the last build
+        """
+        for filename in os.listdir(self.path):
+            if filename.split('.')[0] not in self.used:
+                try:
+                    os.remove(os.path.join(self.path, filename))
+                except OSError:
+                    pass
+
+    def report(self):
+        summary = f"Canvases: {self.reused} reused, {self.rebuilt} rebuilt"
+        print(summary)
+        logging.info(summary)
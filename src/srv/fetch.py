@@ -0,0 +1,144 @@
+import logging
+import threading
+import requests
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+from src.opt.variables import FETCH_WORKERS, FETCH_PER_HOST, FETCH_TIMEOUT
+from src.srv.cache import HttpCache
+from src.opt.profiler import PROFILER
+
+
+class Fetcher:
+    def __init__(self, workers: int = FETCH_WORKERS, per_host: int = FETCH_PER_HOST, timeout: int = FETCH_TIMEOUT):
+        """
+        HTTP layer for IIIF documents with a pooled session (keep-alive) and a bounded pool of workers.
+        :param workers: int, number of concurrent requests
+        :param per_host: int, maximum of concurrent requests by host
+        :param timeout: int, timeout of requests in seconds
+        """
+        # responses of prefetch not read yet
+        self.results = {}
+        self._lock = threading.Lock()
+        self.configure(workers=workers, per_host=per_host, timeout=timeout)
+
+    def configure(self, workers: int = FETCH_WORKERS, per_host: int = FETCH_PER_HOST, timeout: int = FETCH_TIMEOUT,
+                  cache: HttpCache = None):
+        """
+        (Re)build the session and the limits by host.
+        :param cache: HttpCache, persistent cache of requests (disabled if None)
+        """
+        self.cache = cache
+        self.workers = max(1, workers)
+        self.per_host = max(1, per_host)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.limits = {}
+
+    def _get_limit(self, uri: str) -> threading.BoundedSemaphore:
+        host = urlparse(uri).netloc
+        with self._lock:
+            if host not in self.limits:
+                self.limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self.limits[host]
+
+    def get(self, uri: str) -> requests.Response:
+        """
+        Request http GET. Get the response of prefetch if the uri was already resolved : it is given once and
+        released, the document parsed from it is kept by REGISTRY.
+        :param uri: str
+        :return: Response
+        """
+        response = self.results.pop(uri, None)
+        if response is None:
+            response = self._fetch(uri)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def _request(self, uri: str, headers: dict) -> requests.Response:
+        with PROFILER.stage('http', uri=uri):
+            return self.session.get(uri, headers=headers, allow_redirects=True, timeout=self.timeout)
+
+    def _fetch(self, uri: str) -> requests.Response or Exception:
+        with self._get_limit(uri):
+            try:
+                if self.cache is not None:
+                    return self.cache.get(uri, self._request)
+                return self._request(uri, {})
+            except requests.RequestException as err:
+                logging.error(f"Une erreur s'est produite : uri: {str(uri)} , {str(err)}")
+                return err
+
+    def prefetch(self, uris: list) -> dict:
+        """
+        Resolve concurrently all uris needed by the build. Documents already in REGISTRY are not requested again.
+        :param uris: list of str
+        :return: dict, {uri: Response or Exception} of the uris requested
+        """
+        uris = [uri for uri in dict.fromkeys(uris) if uri not in self.results and uri not in REGISTRY]
+        results = {}
+        if len(uris) > 0:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = dict(zip(uris, executor.map(self._fetch, uris)))
+            self.results.update(results)
+            logging.info(f"Prefetch of {str(len(uris))} documents")
+        return results
+
+
+class Registry:
+    def __init__(self):
+        """
+        Process-wide memoization of remote documents (and objects derived from them) keyed by URI,
+        so that each document is fetched and parsed at most once by run.
+        Documents are shared between objects : they must be read only.
+        """
+        self.documents = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def __contains__(self, key) -> bool:
+        return key in self.documents
+
+    def resolve(self, key, factory):
+        """
+        Get memoized object or build it with factory.
+        :param key: str (URI) or tuple
+        :param factory: function without arguments, called only on the first resolution of the key
+        :return: object
+        """
+        with self._lock:
+            if key in self.documents:
+                self.hits += 1
+                return self.documents[key]
+            lock = self._locks.setdefault(key, threading.Lock())
+        # Only one build by key, even with concurrent resolutions
+        with lock:
+            with self._lock:
+                if key in self.documents:
+                    self.hits += 1
+                    return self.documents[key]
+            document = factory()
+            with self._lock:
+                self.misses += 1
+                self.documents[key] = document
+            return document
+
+    def stats(self) -> namedtuple:
+        """
+        :return: namedtuple(hits, misses, documents)
+        """
+        Stats = namedtuple('Stats', ['hits', 'misses', 'documents'])
+        return Stats(hits=self.hits, misses=self.misses, documents=len(self.documents))
+
+
+# Shared by all IIIF objects of the run
+FETCHER = Fetcher()
+REGISTRY = Registry()
@@ -1,23 +1,273 @@
-import http.server
 import os
+import sys
+import hashlib
+import mimetypes
+import socket
+import logging
+import threading
+import http.server
+from email.utils import formatdate
+
+from path import OUTPUT_PATH
+from src.opt.variables import CACHE_CONTROL, ENCODINGS, SERVER_TIMEOUT
+
+
+class OutputIndex:
+    def __init__(self, path: str = OUTPUT_PATH):
+        """
+        In-memory index of the output directory : files with their strong ETag (content hash) and their
+        precompressed variants. Listing is refreshed when the directory changes, and entries when their file changes.
+        :param path: str, output directory
+        """
+        self.path = path
+        self.files = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()[:32]
+
+    def _entry(self, name: str) -> dict or None:
+        """
+        Get entry of file, computed again if the file changed. The file is hashed without the lock, so other files
+        are served meanwhile, and only its entry is swapped under the lock.
+        """
+        path = os.path.join(self.path, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self.files.get(name)
+        if entry is None or entry['stamp'] != (stat.st_mtime_ns, stat.st_size):
+            entry = {'path': path,
+                     'stamp': (stat.st_mtime_ns, stat.st_size),
+                     'size': stat.st_size,
+                     'mtime': stat.st_mtime,
+                     'etag': self._hash(path),
+                     'type': mimetypes.guess_type(name)[0] or 'application/octet-stream'}
+            with self._lock:
+                # not listed anymore if the directory changed meanwhile
+                if name in self.files:
+                    self.files[name] = entry
+        return entry
+
+    def refresh(self):
+        """
+        Update listing of the directory if it changed
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            self.files, self._mtime = {}, None
+            return
+        if mtime != self._mtime:
+            names = [name for name in os.listdir(self.path) if os.path.isfile(os.path.join(self.path, name))]
+            self.files = {name: entry for name, entry in self.files.items() if name in names}
+            for name in names:
+                self.files.setdefault(name, None)
+            self._mtime = mtime
+
+    def get(self, name: str, accept_encoding: str = '') -> (dict, str) or (None, None):
+        """
+        Get file to serve : the best precompressed variant accepted by the client, or the file.
+        :param name: str, filename in the output directory
+        :param accept_encoding: str, header Accept-Encoding
+        :return: tuple (entry, encoding or None)
+        """
+        with self._lock:
+            self.refresh()
+            names = set(self.files)
+        if name not in names:
+            return None, None
+        entry = self._entry(name)
+        if entry is None:
+            return None, None
+        accepted = self.parse_accept_encoding(accept_encoding)
+        for encoding, ext in ENCODINGS.items():
+            if encoding in accepted and name + ext in names:
+                variant = self._entry(name + ext)
+                # variant must be up to date with the file
+                if variant is not None and variant['mtime'] >= entry['mtime']:
+                    return {**variant, 'type': entry['type'], 'etag': entry['etag'] + '-' + encoding}, encoding
+        return entry, None
+
+    @staticmethod
+    def parse_accept_encoding(header: str) -> set:
+        """
+        :param header: str, e.g. 'gzip, deflate, br;q=0.9, *;q=0'
+        :return: set of accepted encodings
+        """
+        accepted = set()
+        for part in (header or '').split(','):
+            values = part.strip().split(';')
+            encoding = values[0].strip().lower()
+            q = 1.
+            for param in values[1:]:
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.
+            if encoding and q > 0:
+                accepted.add(encoding)
+        return accepted
+
+
+# Shared by all requests
+OUTPUT_INDEX = OutputIndex()
+
 
 class MyHttpRequestHandler(http.server.SimpleHTTPRequestHandler):
-    def _set_headers(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
+    # keep-alive : every response has a Content-Length
+    protocol_version = 'HTTP/1.1'
+    # idle keep-alive connections are closed to release their thread
+    timeout = SERVER_TIMEOUT
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=OUTPUT_PATH, **kwargs)
+
+    def end_headers(self):
+        # CORS for IIIF viewers
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag, Content-Length, Content-Encoding, Content-Range, '
+                                                          'Accept-Ranges')
+        super().end_headers()
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header('Access-Control-Allow-Methods', 'GET, HEAD, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Accept, Accept-Encoding, If-None-Match, If-Range, Range')
+        self.send_header('Access-Control-Max-Age', '86400')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
     def do_HEAD(self):
-        self._set_headers()
+        self._serve(body=False)
 
     def do_GET(self):
-        # self._set_headers()
+        self._serve(body=True)
+
+    def _not_modified(self, etag: str) -> bool:
+        header = self.headers.get('If-None-Match')
+        if header is None:
+            return False
+        tags = [tag.strip() for tag in header.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+
+    def _range(self, etag: str, size: int) -> (int, int) or None:
+        """
+        Get the single byte range requested (several ranges are answered with all the file).
+        :return: tuple (first byte, last byte), None for all the file
+        :raise: ValueError if the range is not satisfiable
+        """
+        header = self.headers.get('Range')
+        if header is None or not header.startswith('bytes=') or ',' in header:
+            return None
+        # range of a previous version of the file
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range.strip() != etag:
+            return None
+        first, _, last = header[len('bytes='):].strip().partition('-')
+        try:
+            if first == '':
+                # suffix : last bytes
+                length = int(last)
+                if length <= 0:
+                    raise ValueError
+                return max(0, size - length), size - 1
+            first = int(first)
+            last = min(int(last), size - 1) if last else size - 1
+        except ValueError:
+            return None
+        if first >= size or last < first:
+            raise ValueError(f"Range not satisfiable: {header}")
+        return first, last
+
+    def _send_body(self, f, offset: int, count: int):
+        """
+        Send part of the file with os.sendfile (zero-copy), socket.sendfile falls back on send() elsewhere
+        """
+        self.wfile.flush()
+        self.connection.sendfile(f, offset, count)
+
+    def _serve(self, body: bool):
+        name = self.path.split('?')[0].split('#')[0].lstrip('/')
+        # directory listing
+        if name == '' or '/' in name:
+            return super().do_GET() if body else super().do_HEAD()
+
+        entry, encoding = OUTPUT_INDEX.get(name, self.headers.get('Accept-Encoding', ''))
+        if entry is None:
+            self.send_error(404, "File not found")
+            return
+        etag = f'"{entry["etag"]}"'
+
+        if self._not_modified(etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', CACHE_CONTROL)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+
+        try:
+            f = open(entry['path'], 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            try:
+                byte_range = self._range(etag, size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            first, last = byte_range if byte_range is not None else (0, size - 1)
+
+            self.send_response(200 if byte_range is None else 206)
+            self.send_header('Content-Type', entry['type'])
+            if encoding is not None:
+                self.send_header('Content-Encoding', encoding)
+            if byte_range is not None:
+                self.send_header('Content-Range', f'bytes {first}-{last}/{size}')
+            self.send_header('Content-Length', str(last - first + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Last-Modified', formatdate(entry['mtime'], usegmt=True))
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', CACHE_CONTROL)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            if body and last >= first:
+                self._send_body(f, first, last - first + 1)
+
 
-        if self.path == '/':
-            self.path = 'output/'
+class ManifestServer(http.server.ThreadingHTTPServer):
+    # pending connections before they are accepted
+    request_queue_size = 128
+    # threads of the connections don't block the exit
+    daemon_threads = True
 
-        for file in os.listdir('output/'):
-            if self.path == f'/{file}':
-                self.path = f'output/{file}'
+    def __init__(self, server_address: tuple, handler=MyHttpRequestHandler):
+        """
+        HTTP server of the output directory : each connection is served by its own thread, so a slow client or an
+        idle keep-alive connection (closed after SERVER_TIMEOUT) doesn't block the others.
+        :param server_address: tuple (host, port), port 0 for a free port
+        :param handler: request handler
+        """
+        super().__init__(server_address, handler)
 
-        return http.server.SimpleHTTPRequestHandler.do_GET(self)
\ No newline at end of file
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (ConnectionError, socket.timeout)):
+            # client gone
+            return
+        logging.error(f"Une erreur s'est produite : serveur : {client_address}", exc_info=True)
@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from path import DATA_PATH
+from src.opt.profiler import PROFILER
+
+# Result of a transfer (size and seconds of transfer, error is None if succeed)
+Transfer = namedtuple('Transfer', ['local', 'remote', 'size', 'seconds', 'error'])
+# Size of blocks read and written
+CHUNK_SIZE = 32768
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Token bucket to shape bandwidth shared by all uploads.
+        :param rate: float, bytes by second
+        :param capacity: float, maximum burst in bytes (1 second of rate by default)
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n: int):
+        """
+        Wait until n bytes can be sent.
+        :param n: int, bytes
+        """
+        while n > 0:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                take = min(n, self.tokens)
+                self.tokens -= take
+                n -= take
+                wait = n / self.rate if n > 0 else 0
+            if wait > 0:
+                time.sleep(min(wait, self.capacity / self.rate))
+
+
+class UploadJournal:
+    def __init__(self, path: str = os.path.join(DATA_PATH, 'upload_journal.jsonl')):
+        """
+        Local journal of uploads, to resume an interrupted run.
+        {remote path: {'local', 'size', 'mtime', 'status': 'partial' or 'done'}}
+        Each update is appended as one json line, the log is compacted (one line by remote path) when it is loaded.
+        :param path: str, json lines file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line cut by an interrupted run
+                        continue
+                    self.entries[entry.pop('remote')] = entry
+        except OSError:
+            return
+        self._compact()
+
+    def _compact(self):
+        """
+        Rewrite the log with the last entry of each remote path
+        """
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for remote, entry in self.entries.items():
+                f.write(json.dumps({'remote': remote, **entry}) + '\n')
+        os.replace(tmp, self.path)
+
+    def get(self, remote: str) -> dict or None:
+        return self.entries.get(remote)
+
+    def _update(self, remote: str, local: str, status: str):
+        stat = os.stat(local)
+        entry = {'local': local, 'size': stat.st_size, 'mtime': int(stat.st_mtime), 'status': status}
+        line = json.dumps({'remote': remote, **entry}) + '\n'
+        with self._lock:
+            self.entries[remote] = entry
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+    def start(self, remote: str, local: str):
+        self._update(remote, local, 'partial')
+
+    def done(self, remote: str, local: str):
+        self._update(remote, local, 'done')
+
+
+class Sync:
+    def __init__(self, session, journal: UploadJournal, checksum: bool = False, verbose: bool = False):
+        """
+        Compare local files with the remote project directory (size, mtime and optional checksum)
+        to upload only new or changed files, and resume partial transfers.
+        :param session: SftpSession
+        :param journal: UploadJournal
+        :param checksum: bool, compare sha256 streamed from both sides when mtime is different
+        :param verbose: bool
+        """
+        self.session = session
+        self.journal = journal
+        self.checksum = checksum
+        self.verbose = verbose
+
+    @staticmethod
+    def sha256(f, length: int = None) -> str:
+        """
+        Streamed checksum of a file object
+        :param f: file object opened in binary mode (local or SFTP)
+        :param length: int, number of bytes to read (all file if None)
+        :return: str, hex digest
+        """
+        digest = hashlib.sha256()
+        while length is None or length > 0:
+            data = f.read(CHUNK_SIZE if length is None else min(CHUNK_SIZE, length))
+            if not data:
+                break
+            digest.update(data)
+            if length is not None:
+                length -= len(data)
+        return digest.hexdigest()
+
+    def _same_content(self, local: str, remote: str, length: int = None) -> bool:
+        def remote_sha256(sftp):
+            with sftp.open(remote, 'rb') as f:
+                f.prefetch()
+                return self.sha256(f, length)
+
+        with open(local, 'rb') as f:
+            local_sha256 = self.sha256(f, length)
+        return local_sha256 == self.session.run(remote_sha256)
+
+    def plan(self, path_project: str, jobs: list) -> list:
+        """
+        Keep jobs of new or changed files. Partial files registered in the journal are resumed.
+        :param path_project: str, remote project directory
+        :param jobs: list of tuple (local path, remote path)
+        :return: list of tuple (local path, remote path, offset)
+        """
+        remote_files = {attr.filename: attr for attr in self.session.run(lambda sftp: sftp.listdir_attr(path_project))}
+
+        planned = []
+        n_skip = n_resume = 0
+        for local, remote in jobs:
+            stat = os.stat(local)
+            attr = remote_files.get(remote.split('/')[-1])
+            entry = self.journal.get(remote)
+            same_local = entry is not None and entry['size'] == stat.st_size and entry['mtime'] == int(stat.st_mtime)
+
+            if attr is None:
+                planned.append((local, remote, 0))
+            elif attr.st_size == stat.st_size:
+                if attr.st_mtime == int(stat.st_mtime) or (same_local and entry['status'] == 'done') \
+                        or (self.checksum and self._same_content(local, remote)):
+                    n_skip += 1
+                else:
+                    planned.append((local, remote, 0))
+            elif attr.st_size < stat.st_size and same_local and entry['status'] == 'partial' \
+                    and (not self.checksum or self._same_content(local, remote, attr.st_size)):
+                n_resume += 1
+                planned.append((local, remote, attr.st_size))
+            else:
+                planned.append((local, remote, 0))
+
+        summary = f"Sync: {n_skip} files up to date, {n_resume} resumed, {len(planned) - n_resume} to upload"
+        print(summary)
+        logging.info(summary)
+        return planned
+
+
+class ParallelUploader:
+    def __init__(self, sessions: list, workers: int, rate: float = None, journal: UploadJournal = None,
+                 verbose: bool = False):
+        """
+        Upload files with concurrent SFTP channels on pooled SSH transports, largest files first.
+        :param sessions: list of SftpSession, transports used in round robin
+        :param workers: int, number of concurrent channels
+        :param rate: float, bandwidth limit in bytes by second for all uploads (None to disable)
+        :param journal: UploadJournal, to register transfers (None to disable)
+        :param verbose: bool
+        """
+        self.sessions = sessions
+        self.workers = max(1, workers)
+        self.bucket = TokenBucket(rate) if rate else None
+        self.journal = journal
+        self.verbose = verbose
+
+    @staticmethod
+    def schedule(jobs: list) -> list:
+        """
+        Order jobs by size to send, largest first, to reduce the total time of upload.
+        :param jobs: list of tuple (local path, remote path) or (local path, remote path, offset)
+        :return: list of tuple (local path, remote path, offset, size to send)
+        """
+        sized = []
+        for job in jobs:
+            local, remote, offset = job if len(job) == 3 else (job[0], job[1], 0)
+            sized.append((local, remote, offset, os.path.getsize(local) - offset))
+        return sorted(sized, key=lambda job: job[3], reverse=True)
+
+    def _put(self, sftp, local: str, remote: str, offset: int):
+        """
+        Write local file in remote path from offset (resume), with bandwidth shaping.
+        The remote mtime is set to the local mtime to compare files on the next sync.
+        """
+        stat = os.stat(local)
+        with open(local, 'rb') as f_local, sftp.open(remote, 'r+b' if offset > 0 else 'wb') as f_remote:
+            f_local.seek(offset)
+            f_remote.seek(offset)
+            f_remote.set_pipelined(True)
+            while True:
+                data = f_local.read(CHUNK_SIZE)
+                if not data:
+                    break
+                if self.bucket is not None:
+                    self.bucket.consume(len(data))
+                f_remote.write(data)
+        if sftp.stat(remote).st_size != stat.st_size:
+            raise IOError(f"Size of remote file {remote} is different from the local file")
+        sftp.utime(remote, (int(stat.st_atime), int(stat.st_mtime)))
+
+    def _upload(self, n: int, job: tuple) -> Transfer:
+        local, remote, offset, size = job
+        session = self.sessions[n % len(self.sessions)]
+        start = time.monotonic()
+        try:
+            if self.journal is not None:
+                self.journal.start(remote, local)
+            with PROFILER.stage('upload', file=remote, size=size):
+                session.run(lambda sftp: self._put(sftp, local, remote, offset))
+            if self.journal is not None:
+                self.journal.done(remote, local)
+            error = None
+        except Exception as err:
+            error = err
+            logging.error(f"Une erreur s'est produite lors du transfert : {str(local)} , {str(err)}", exc_info=True)
+        transfer = Transfer(local=local, remote=remote, size=size, seconds=time.monotonic() - start, error=error)
+        if error is None:
+            logging.info(f"Upload {remote} : {self.throughput(transfer.size, transfer.seconds):.2f} MB/s")
+            if self.verbose:
+                print(f"Upload {remote} : {self.throughput(transfer.size, transfer.seconds):.2f} MB/s")
+        return transfer
+
+    @staticmethod
+    def throughput(size: int, seconds: float) -> float:
+        """
+        :return: float, MB/s
+        """
+        return size / 1e6 / seconds if seconds > 0 else 0.
+
+    def upload(self, jobs: list) -> list:
+        """
+        Run all uploads.
+        :param jobs: list of tuple (local path, remote path) or (local path, remote path, offset)
+        :return: list of Transfer
+        """
+        jobs = self.schedule(jobs)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            transfers = list(executor.map(self._upload, range(len(jobs)), jobs))
+        seconds = time.monotonic() - start
+
+        size = sum(transfer.size for transfer in transfers if transfer.error is None)
+        n_error = sum(1 for transfer in transfers if transfer.error is not None)
+        summary = (f"Uploads: {len(transfers) - n_error} files, {size / 1e6:.1f} MB in {seconds:.1f} s "
+                   f"({self.throughput(size, seconds):.2f} MB/s), errors: {n_error}")
+        print(summary)
+        logging.info(summary)
+        return transfers
@@ -0,0 +1,218 @@
+import os
+import gzip
+import json
+import shutil
+import logging
+from pydantic.json import pydantic_encoder
+from iiif_prezi3 import Manifest, Canvas
+
+from src.opt.variables import OUTPUT_PROFILES
+from src.opt.profiler import PROFILER
+
+# Optional dependency to write .br files
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class ManifestWriter:
+    # Placeholder of canvases in the serialized manifest
+    sentinel = '__CANVASES__'
+
+    def __init__(self, filename: str, manifest: Manifest, stream: bool = False, profile: str = 'pretty'):
+        """
+        Write manifest on disk. In stream mode, the header of the manifest is written at opening, each canvas as soon
+        as it is finished (and released) and the trailer at closing, so memory doesn't grow with the number of
+        canvases. Otherwise, canvases are added in the manifest serialized at closing.
+        All manifest properties (thumbnail, metadata, etc.) must be set before opening in stream mode.
+        Files are written in a temporary file replaced at closing, so the server never serves a partial manifest.
+        :param filename: str, output path
+        :param manifest: Manifest, iiif_prezi3 manifest without canvases
+        :param stream: bool, streaming output
+        :param profile: str, output profile (see OUTPUT_PROFILES) : indented json, or minified json with
+        precompressed .gz and .br siblings
+        """
+        self.filename = filename
+        self.manifest = manifest
+        self.stream = stream
+        self.indent = OUTPUT_PROFILES[profile]['indent']
+        self.precompress = OUTPUT_PROFILES[profile]['precompress']
+        # minified json without spaces
+        self.separators = (',', ':') if self.indent is None else None
+        self.n = 0
+        self.file = None
+        self._trailer = None
+        # canvases already serialized (see write_fragment)
+        self.fragments = []
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _dumps(self, obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, default=pydantic_encoder, indent=self.indent,
+                          separators=self.separators)
+
+    @staticmethod
+    def _to_dict(obj) -> dict:
+        # same options as iiif_prezi3 serialization
+        return obj.dict(exclude_unset=False, exclude_defaults=False, exclude_none=True, by_alias=True)
+
+    def _split(self) -> (str, str):
+        """
+        :return: tuple, serialized manifest before and after its canvases
+        """
+        document = {"@context": "http://iiif.io/api/presentation/3/context.json", **self._to_dict(self.manifest)}
+        document['items'] = [self.sentinel]
+        header, trailer = self._dumps(document).split(json.dumps(self.sentinel))
+        return header, trailer
+
+    def open(self):
+        """
+        Open output and write header of manifest in stream mode
+        :return: ManifestWriter
+        """
+        if self.stream:
+            self.file = open(self.filename + '.tmp', 'w')
+            header, self._trailer = self._split()
+            self.file.write(header)
+        return self
+
+    def to_stream(self):
+        """
+        Switch to stream mode during the build (see MemoryMonitor.check) : canvases added before are written, and
+        released.
+        """
+        if self.stream:
+            return
+        fragments = self.fragments or [self.serialize(canvas) for canvas in self.manifest.items or []]
+        if self.manifest.items:
+            self.manifest.items = []
+        self.fragments = []
+        self.n = 0
+        self.stream = True
+        self.open()
+        for fragment in fragments:
+            self.write_fragment(fragment)
+
+    def serialize(self, canvas: Canvas) -> str:
+        """
+        Serialize canvas as a fragment of the manifest (indented at the level of manifest items)
+        :param canvas: Canvas
+        :return: str
+        """
+        with PROFILER.stage('serialize'):
+            fragment = self._dumps(self._to_dict(canvas))
+            if self.indent is not None:
+                fragment = fragment.replace('\n', '\n' + ' ' * 2 * self.indent)
+        return fragment
+
+    @property
+    def separator(self) -> str:
+        if self.indent is None:
+            return ','
+        return ',\n' + ' ' * 2 * self.indent
+
+    def write(self, canvas: Canvas):
+        """
+        Add canvas in manifest (written on disk in stream mode)
+        :param canvas: Canvas
+        """
+        if self.stream or self.fragments:
+            self.write_fragment(self.serialize(canvas))
+        else:
+            self.manifest.add_item(canvas)
+            self.n += 1
+
+    def write_fragment(self, fragment: str):
+        """
+        Add canvas already serialized with the same profile (see serialize)
+        :param fragment: str
+        """
+        if self.stream:
+            if self.n > 0:
+                self.file.write(self.separator)
+            self.file.write(fragment)
+        else:
+            if not self.fragments and self.manifest.items:
+                # canvases added before are serialized to keep their order
+                self.fragments = [self.serialize(canvas) for canvas in self.manifest.items]
+                self.manifest.items = []
+            self.fragments.append(fragment)
+        self.n += 1
+
+    def close(self):
+        """
+        Write trailer (stream mode) or all manifest
+        """
+        with PROFILER.stage('serialize', file=os.path.basename(self.filename)):
+            self._close()
+        if self.precompress:
+            with PROFILER.stage('compress', file=os.path.basename(self.filename)):
+                self.compress(self.filename)
+        else:
+            # remove outdated precompressed files of a previous build
+            for ext in ('.gz', '.br'):
+                if os.path.exists(self.filename + ext):
+                    os.remove(self.filename + ext)
+
+    def _close(self):
+        if self.stream:
+            if self.file is not None:
+                if self.n == 0:
+                    # without canvas, same output as the manifest serialized at once
+                    self.file.seek(0)
+                    self.file.truncate()
+                    self.file.write(self.manifest.json(indent=self.indent, separators=self.separators,
+                                                       ensure_ascii=False))
+                else:
+                    self.file.write(self._trailer)
+                self.file.close()
+                self.file = None
+                os.replace(self.filename + '.tmp', self.filename)
+        elif self.fragments:
+            header, trailer = self._split()
+            with open(self.filename + '.tmp', 'w') as outfile:
+                outfile.write(header + self.separator.join(self.fragments) + trailer)
+            os.replace(self.filename + '.tmp', self.filename)
+        else:
+            with open(self.filename + '.tmp', 'w') as outfile:
+                outfile.write(self.manifest.json(indent=self.indent, separators=self.separators, ensure_ascii=False))
+            os.replace(self.filename + '.tmp', self.filename)
+
+    @staticmethod
+    def compress(filename: str) -> dict:
+        """
+        Write precompressed siblings of the file (.gz, and .br if brotli is installed) to serve them
+        without compression on every request, and report the size reduction.
+        :param filename: str
+        :return: dict, {extension: size in bytes}
+        """
+        sizes = {'': os.path.getsize(filename)}
+        # name of the file in the gzip header, not the temporary file
+        with open(filename, 'rb') as f_in, open(filename + '.gz.tmp', 'wb') as f_tmp, \
+                gzip.GzipFile(filename + '.gz', 'wb', compresslevel=9, fileobj=f_tmp, mtime=0) as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.replace(filename + '.gz.tmp', filename + '.gz')
+        sizes['.gz'] = os.path.getsize(filename + '.gz')
+
+        if brotli is not None:
+            compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=11)
+            with open(filename, 'rb') as f_in, open(filename + '.br.tmp', 'wb') as f_out:
+                for block in iter(lambda: f_in.read(1024 * 1024), b''):
+                    f_out.write(compressor.process(block))
+                f_out.write(compressor.finish())
+            os.replace(filename + '.br.tmp', filename + '.br')
+            sizes['.br'] = os.path.getsize(filename + '.br')
+        else:
+            logging.warning("Module 'brotli' is not installed : no .br file.")
+
+        summary = f"{os.path.basename(filename)}: {sizes[''] / 1e3:.1f} kB" + ''.join(
+            f", {ext} {size / 1e3:.1f} kB (-{100 * (1 - size / sizes['']) if sizes[''] else 0:.0f}%)"
+            for ext, size in sizes.items() if ext != '')
+        print(summary)
+        logging.info(summary)
+        return sizes